@@ -1,13 +1,74 @@
-import os, json, time, re, argparse, exiftool, threading, queue, calendar, io, uuid
-import copy
-import shutil
-import sys
-
-from json_repair import repair_json as rj
-from datetime import timedelta
-from llmii_utils import first_json, de_pluralize, AND_EXCEPTIONS
-from koboldapi import KoboldAPICore, ImageProcessor
+import os, json, time, re, argparse, threading, queue, uuid
+import random
+import signal
+
+from llmii_utils import first_json, de_pluralize, AND_EXCEPTIONS, JsonStreamScanner
+from llmii_queue import WorkQueue
+from llmii_checkpoint import CheckpointJournal
+from llmii_profiles import IMAGE_PROFILES
+from llmii_budget import MemoryBudget, approx_size
+from llmii_record import FileRecord
+from llmii_vocab import KeywordVocabulary
+from llmii_search import SearchIndex
+from llmii_schedule import ScheduledQueue, SCHEDULE_POLICIES
+from llmii_archive import ResponseArchive
+from llmii_profile import RunProfiler, PROFILE_MODES
+from llmii_exiftool import ExifToolSupervisor, ExifToolGaveUp
+from llmii_async import AsyncEngine, AsyncKoboldClient, AsyncKoboldError, ImagePayload, LatencyTracker
+
+# Native file system events for --watch. Without it the tree is polled
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
     
+# These are the fields we check. ExifTool returns are kind of strange, not always
+# conforming to where they are or what they actually are named. These should find all of them
+KEYWORD_FIELDS = [
+    "Keywords",
+    "IPTC:Keywords",
+    "Composite:keywords",
+    "Subject",
+    "DC:Subject",
+    "XMP:Subject",
+    "XMP-dc:Subject"
+]
+CAPTION_FIELDS = [
+    "Description",
+    "XMP:Description",
+    "ImageDescription",
+    "DC:Description",
+    "EXIF:ImageDescription",
+    "Composite:Description",
+    "Caption",
+    "IPTC:Caption",
+    "Composite:Caption",
+    "IPTC:Caption-Abstract",
+    "XMP-dc:Description",
+    "PNG:Description"
+]
+IDENTIFIER_FIELDS = [
+    "Identifier",
+    "XMP:Identifier",            
+]
+STATUS_FIELDS = [
+    "Status",
+    "XMP:Status"
+]
+
+# Tag as ExifTool returns it -> the field it is standardized to
+FIELD_LOOKUP = {
+    **{field: "MWG:Keywords" for field in KEYWORD_FIELDS},
+    **{field: "MWG:Description" for field in CAPTION_FIELDS},
+    **{field: "XMP:Identifier" for field in IDENTIFIER_FIELDS},
+    **{field: "XMP:Status" for field in STATUS_FIELDS},
+}
+
+# Words in the prompt tend to get repeated back by certain models
+BANNED_WORDS = ["no", "unspecified", "unknown", "standard", "unidentified", "time", "category", "actions", "setting", "objects", "visual", "elements", "activities", "appearance", "professions", "relationships", "identify", "photography", "photographic", "topiary"]
+
 def split_on_internal_capital(word):
     """ Split a word if it contains a capital letter after the 4th position.
         Returns the original word if no split is needed, or the split 
@@ -115,6 +176,13 @@ def normalize_keyword(keyword, banned_words):
     # Return the original tokens (preserving hyphens)
     return ' '.join(tokens)
     
+def rj(data):
+    """ Repair broken JSON. json_repair is only imported the first time 
+        a response needs it.
+    """
+    from json_repair import repair_json
+    return repair_json(data)
+    
 def clean_string(data):
     if isinstance(data, dict):
         data = json.dumps(data)
@@ -171,6 +239,60 @@ def find_keywords(data):
         keywords = [word.strip() for word in remaining_string.split(',') if word.strip()]
     return {"Keywords": keywords}
     
+def split_batch_response(data, count):
+    """ Pull the result for each image out of the answer to a batched
+        request. Returns {position: {"Caption": str, "Keywords": []}}
+        with positions counted from 0. Entries are matched by their Index,
+        counted from 1 unless some entry uses 0. Entries without an Index
+        are only matched by their place in the array when it has exactly
+        one entry per image. Entries without keywords or that can't be
+        matched to an image are left out, and so are left to be
+        generated on their own.
+    """
+    if isinstance(data, str):
+        match = re.search(r"```json\s*(.*?)\s*```", data, re.DOTALL)
+        if match:
+            data = match.group(1).strip()
+        try:
+            data = json.loads(rj(data))
+        except:
+            return {}
+    if isinstance(data, dict):
+    
+        # A single object, or the array wrapped in one
+        if "Keywords" in data:
+            data = [data]
+        else:
+            lists = [value for value in data.values() if isinstance(value, list)]
+            data = lists[0] if lists else []
+    if not isinstance(data, list):
+        return {}
+        
+    indexes = []
+    for item in data:
+        index = None
+        if isinstance(item, dict):
+            try:
+                index = int(item.get("Index", item.get("index")))
+            except (TypeError, ValueError):
+                pass
+        indexes.append(index)
+    offset = 0 if 0 in indexes else 1
+    
+    entries = {}
+    for position, (item, index) in enumerate(zip(data, indexes)):
+        if not isinstance(item, dict) or not item.get("Keywords"):
+            continue
+        if index is not None:
+            index -= offset
+        elif len(data) == count:
+            index = position
+        else:
+            continue
+        if 0 <= index < count and index not in entries:
+            entries[index] = item
+    return entries
+    
 def clean_json(data):
     """ LLMs like to return all sorts of garbage.
         Even when asked to give a structured output
@@ -221,6 +343,65 @@ def clean_json(data):
             print(f"Failed to parse JSON: {data}")          
     return None
 
+def loose_fields(data):
+    """ Find the caption and keywords in a parsed response whatever 
+        case, name or shape the model gave them in. Returns None if
+        there are no keywords.
+    """
+    if isinstance(data, list):
+        if data and all(isinstance(item, str) for item in data):
+            return {"Keywords": data}
+        data = next((item for item in data if isinstance(item, dict)), None)
+    if not isinstance(data, dict):
+        return None
+    fields = {str(key).lower(): value for key, value in data.items()}
+    keywords = fields.get("keywords") or fields.get("keyword") or fields.get("tags")
+    if isinstance(keywords, str):
+        keywords = [k.strip() for k in keywords.split(",") if k.strip()]
+    if not keywords or not isinstance(keywords, list):
+        return None
+    result = {"Keywords": keywords}
+    caption = fields.get("caption") or fields.get("description")
+    if isinstance(caption, str):
+        result["Caption"] = caption
+    return result
+    
+def relaxed_parse(data):
+    """ A second look at a response clean_json got no keywords from.
+        clean_json stops at the first tier that loads at all, this 
+        tries every tier and takes the first that has keywords under
+        any reasonable name.
+    """
+    if not isinstance(data, str):
+        return None
+    sources = [data]
+    match = re.search(r"```(?:json)?\s*(.*?)\s*```", data, re.DOTALL)
+    if match:
+        sources.insert(0, match.group(1))
+    tiers = (
+        lambda text: json.loads(rj(text)),
+        lambda text: json.loads(rj(first_json(text))),
+        markdown_list_to_dict,
+        lambda text: json.loads(first_json(rj("{" + text + "}"))),
+        find_keywords,
+    )
+    for source in sources:
+        for tier in tiers:
+            try:
+                result = loose_fields(tier(source))
+            except Exception:
+                continue
+            if result:
+                return result
+    return None
+    
+def looks_truncated(text):
+    """ True if a response stops inside its JSON, which usually means it
+        ran out of tokens.
+    """
+    if not isinstance(text, str) or "{" not in text:
+        return False
+    return text.count("{") > text.count("}") or text.count("[") > text.count("]")
 
 class Config:
     def __init__(self):
@@ -242,6 +423,38 @@ class Config:
         self.quick_fail = False
         self.no_caption = False
         self.update_caption = False
+        self.work_queue = None
+        self.coordinator = False
+        self.lease_seconds = 600
+        self.queue_batch_size = 50
+        self.concurrency = 1
+        self.stream = False
+        self.checkpoint = None
+        self.resume = False
+        self.image_profile = "default"
+        self.max_buffer_mb = None
+        self.batch_images = 1
+        self.request_timeout = 300
+        self.retry_generations = 1
+        self.archive = None
+        self.reparse_from_archive = False
+        self.retry_temperature = 0.7
+        self.exiftool_timeout = 30
+        self.exiftool_max_hangs = 10
+        self.profile = None
+        self.profile_dir = "."
+        self.profile_every = 100
+        self.hedge = False
+        self.hedge_urls = []
+        self.schedule = "fifo"
+        self.priority_dirs = []
+        self.failed_last = False
+        self.watch = False
+        self.watch_poll = False
+        self.watch_interval = 10
+        self.watch_settle = 5
+        self.vocabulary = None
+        self.index = None
         self.caption_instruction = "Describe the image."
         self.system_instruction = "You are a helpful assistant."
         self.instruction = """First, generate a detailed caption for the image.
@@ -265,6 +478,12 @@ Next, generate 7 unique one or two word keywords for the image. Include the foll
    
 Limit response to things clearly and obviously apparent; do not guess. Do not combine words. Use ENGLISH only. Generate ONLY a JSON object with the keys Caption and Keywords as follows {"Caption": str, "Keywords": []}"""
 
+        self.batch_instruction = """You are given {count} images, numbered 1 to {count} in the order they are attached.
+
+For each image, generate a detailed caption and 7 unique one or two word keywords. Include themes, concepts, items, animals, objects, setting, notable colors, textures, styles, actions and human demographics when present.
+
+Limit response to things clearly and obviously apparent; do not guess. Do not combine words. Use ENGLISH only. Generate ONLY a JSON array with one object per image, in order, as follows [{{"Index": 1, "Caption": str, "Keywords": []}}, ...]"""
+
         self.image_extensions = {
         "JPEG": [
             ".jpg",
@@ -348,6 +567,102 @@ Limit response to things clearly and obviously apparent; do not guess. Do not co
         parser.add_argument("--quick-fail", action="store_true", help="Mark failed after one try")
         parser.add_argument("--short-caption", action="store_true", help="Write a short caption along with keywords")
         parser.add_argument("--no-caption", action="store_true", help="Do not modify caption")
+        parser.add_argument(
+            "--work-queue", default=None, help="Shared SQLite work queue file for tagging one tree from several machines"
+        )
+        parser.add_argument(
+            "--coordinator", action="store_true", help="Scan the directory and publish files to the work queue"
+        )
+        parser.add_argument(
+            "--lease-seconds", type=int, default=600, help="Seconds before a leased batch returns to the work queue"
+        )
+        parser.add_argument(
+            "--queue-batch-size", type=int, default=50, help="Number of files to lease from the work queue at once"
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=1, help="Number of generations to keep in flight at once"
+        )
+        parser.add_argument(
+            "--stream", action="store_true", help="Stream generations and stop as soon as the keywords arrive"
+        )
+        parser.add_argument(
+            "--checkpoint", default=None, help="Journal file recording finished files so a run can be resumed"
+        )
+        parser.add_argument(
+            "--resume", action="store_true", help="Skip files and directories finished according to the checkpoint journal"
+        )
+        parser.add_argument(
+            "--image-profile", default="default", choices=list(IMAGE_PROFILES), help="Image size and encoding profile for the model family"
+        )
+        parser.add_argument(
+            "--max-buffer-mb", type=int, default=None, help="Limit the memory held by queued files, metadata and images"
+        )
+        parser.add_argument(
+            "--request-timeout", type=int, default=300, help="Abort a generation that takes longer than this many seconds, 0 to wait forever"
+        )
+        parser.add_argument(
+            "--archive", default=None, help="Directory to keep every raw model response in"
+        )
+        parser.add_argument(
+            "--reparse-from-archive", action="store_true", help="Redo keywords and captions from the --archive responses without the model"
+        )
+        parser.add_argument(
+            "--retry-generations", type=int, default=1, help="Extra generations to spend on a file whose response couldn't be used"
+        )
+        parser.add_argument(
+            "--retry-temperature", type=float, default=0.7, help="Temperature for generating again after a failure"
+        )
+        parser.add_argument(
+            "--exiftool-timeout", type=float, default=30, help="Seconds before a hung ExifTool is restarted, plus half a second per file in the call"
+        )
+        parser.add_argument(
+            "--exiftool-max-hangs", type=int, default=10, help="Times ExifTool may hang or crash before it isn't restarted any more"
+        )
+        parser.add_argument(
+            "--profile", default=None, choices=PROFILE_MODES, help="Profile the run: cpu with cProfile, mem with tracemalloc snapshots or sample with a sampling thread"
+        )
+        parser.add_argument(
+            "--profile-dir", default=".", help="Directory to write the profile report to"
+        )
+        parser.add_argument(
+            "--profile-every", type=int, default=100, help="Files between memory snapshots with --profile mem"
+        )
+        parser.add_argument(
+            "--hedge", action="store_true", help="Send a second copy of a generation that runs longer than usual and use whichever finishes first"
+        )
+        parser.add_argument(
+            "--hedge-url", dest="hedge_urls", action="append", default=[], help="Other KoboldCpp server for hedged copies, can be repeated"
+        )
+        parser.add_argument(
+            "--batch-images", type=int, default=1, help="Experimental: describe this many images with each request"
+        )
+        parser.add_argument(
+            "--schedule", default="fifo", choices=list(SCHEDULE_POLICIES), help="Order to process directories and files in"
+        )
+        parser.add_argument(
+            "--priority-dir", dest="priority_dirs", action="append", default=[], help="Process this directory before any other, can be repeated"
+        )
+        parser.add_argument(
+            "--failed-last", action="store_true", help="Reprocess files that failed before only after everything else"
+        )
+        parser.add_argument(
+            "--watch", action="store_true", help="Keep running and tag new images as they arrive"
+        )
+        parser.add_argument(
+            "--watch-poll", action="store_true", help="Poll for new images instead of using file system events, for network mounts"
+        )
+        parser.add_argument(
+            "--watch-interval", type=int, default=10, help="Seconds between polls when watching"
+        )
+        parser.add_argument(
+            "--watch-settle", type=int, default=5, help="Seconds a new file must stay unchanged before it is tagged"
+        )
+        parser.add_argument(
+            "--vocabulary", default=None, help="File to keep keyword counts in across runs"
+        )
+        parser.add_argument(
+            "--index", default=None, help="Search index file to record keywords and captions in"
+        )
         args = parser.parse_args()
 
         config = cls()
@@ -355,7 +670,218 @@ Limit response to things clearly and obviously apparent; do not guess. Do not co
             setattr(config, key, value)
         return config
 
+class AsyncLLMProcessor:
+    """ Asyncio version of LLMProcessor. Many generations can be in
+        flight at once on a single event loop, sharing one pooled
+        HTTP session.
+    """
+    def __init__(self, config, core):
+        self.config = config
+        self.instruction = config.instruction
+        self.system_instruction = config.system_instruction
+        self.caption_instruction = config.caption_instruction
+        
+        # The sync core is only used to wrap prompts in the model's template
+        self.core = core
+        self.client = AsyncKoboldClient(
+            config.api_url,
+            config.api_password,
+            max_connections=max(config.concurrency, 1),
+            **core.get_generation_params()
+        )
+        
+        # Hedged copies go to the other backends in turn, or to another
+        # slot on the same one if there are none. They get connections
+        # of their own, since with every pooled one busy a hedge would
+        # only start once the request it is racing had finished.
+        self.hedge_clients = [
+            AsyncKoboldClient(
+                url, config.api_password, max_connections=max(config.concurrency, 1), **core.get_generation_params()
+            )
+            for url in config.hedge_urls or [config.api_url]
+        ]
+        self.hedge_turn = 0
+        self.latency = LatencyTracker()
+        self.stats = {"timeouts": 0, "hedged": 0, "hedge_wins": 0}
+        
+    def build_prompt(self, task):
+        if task == "caption":
+            instruction = self.caption_instruction
+        elif task == "keywords":
+            instruction = self.instruction
+        elif task == "caption_and_keywords":
+            instruction = self.instruction
+        else:
+            print(f"invalid task: {task}")
+            return None
+        return self.core.template_wrapper.wrap_prompt(
+            instruction=instruction, system_instruction=self.system_instruction, content=""
+        )
+        
+    async def describe_content(self, task="", processed_image=None, **kwargs):
+        """ Generate for one task. kwargs override the generation
+            parameters for this request only.
+        """
+        if not processed_image:
+            print("No image to describe.")
+            return None
+        prompt = self.build_prompt(task)
+        if prompt is None:
+            return None
+        if not isinstance(processed_image, ImagePayload):
+            processed_image = ImagePayload(processed_image)
+        if self.config.stream and task != "caption":
+            return await self._generate_until_keywords(prompt, processed_image, **kwargs)
+        return await self._generate(prompt, processed_image, **kwargs)
+        
+    async def continue_content(self, task, processed_image, partial):
+        """ Let the model carry on from a response that was cut off and
+            return the whole thing.
+        """
+        prompt = self.build_prompt(task)
+        if prompt is None or not processed_image:
+            return partial
+        return partial + await self._generate(prompt + partial, processed_image, record_latency=False)
+        
+    def _hedge_delay(self):
+        if not self.config.hedge:
+            return None
+        return self.latency.percentile(95)
+        
+    async def _generate(self, prompt, processed_image, timeout=None, record_latency=True, **kwargs):
+        """ Run one generation under the request deadline. One that is
+            still running past the usual p95 latency gets a hedged copy
+            and whichever finishes first wins. The loser, and anything 
+            past the deadline, is aborted on the server so it stops 
+            using the GPU.
+            
+            Only generations for one image from scratch should be
+            recorded, or batches and continuations would skew the p95
+            the hedge waits for.
+        """
+        import asyncio
+        timeout = timeout or self.config.request_timeout or None
+        hedge_delay = self._hedge_delay()
+        start = time.monotonic()
+        attempts = {}
+        
+        def launch(client):
+            genkey = client.new_genkey()
+            task = asyncio.create_task(client.generate(prompt, genkey=genkey, image=processed_image, **kwargs))
+            attempts[task] = (client, genkey)
+            return task
+            
+        primary = launch(self.client)
+        hedged = False
+        error = None
+        try:
+            while attempts:
+                elapsed = time.monotonic() - start
+                waits = []
+                if timeout:
+                    waits.append(timeout - elapsed)
+                if hedge_delay is not None and not hedged:
+                    waits.append(hedge_delay - elapsed)
+                wait = max(min(waits), 0) if waits else None
+                done, _ = await asyncio.wait(attempts, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempts.pop(task)
+                    if task.exception() is None:
+                        if record_latency:
+                            self.latency.add(time.monotonic() - start)
+                        if task is not primary:
+                            self.stats["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+                if done:
+                    continue
+                    
+                if timeout and time.monotonic() - start >= timeout:
+                    self.stats["timeouts"] += 1
+                    raise AsyncKoboldError(f"Generation timed out after {timeout}s")
+                if not hedged:
+                    hedged = True
+                    self.stats["hedged"] += 1
+                    client = self.hedge_clients[self.hedge_turn % len(self.hedge_clients)]
+                    self.hedge_turn += 1
+                    launch(client)
+            raise error
+        finally:
+            for task, (client, genkey) in attempts.items():
+                task.cancel()
+                await client.abort(genkey)
+        
+    async def describe_batch(self, processed_images):
+        """ Describe several images with one generation. The answer 
+            should be a JSON array with an entry per image.
+        """
+        instruction = self.config.batch_instruction.format(count=len(processed_images))
+        prompt = self.core.template_wrapper.wrap_prompt(
+            instruction=instruction, system_instruction=self.system_instruction, content=""
+        )
+        payloads = [i if isinstance(i, ImagePayload) else ImagePayload(i) for i in processed_images]
+        
+        # Leave room, and time, for an answer per image
+        timeout = self.config.request_timeout * len(payloads) if self.config.request_timeout else None
+        return await self._generate(
+            prompt, ImagePayload.combine(payloads), timeout=timeout, record_latency=False,
+            max_length=int(self.config.gen_count) * len(payloads)
+        )
+        
+    async def _generate_until_keywords(self, prompt, processed_image, **kwargs):
+        """ Stream the generation and abort it as soon as a complete 
+            JSON object with keywords has arrived. Models like to keep
+            talking after the closing brace and we don't need any of it.
+        """
+        import asyncio
+        genkey = self.client.new_genkey()
+        scanner = JsonStreamScanner()
+        text = []
+        
+        async def consume():
+            stream = self.client.stream(prompt, genkey=genkey, image=processed_image, **kwargs)
+            try:
+                async for token in stream:
+                    text.append(token)
+                    for obj in scanner.feed(token):
+                        if any(str(key).lower() == "keywords" for key in obj):
+                            await self.client.abort(genkey)
+                            return "".join(text)
+            finally:
+                await stream.aclose()
+            return "".join(text)
+            
+        timeout = self.config.request_timeout or None
+        try:
+            return await asyncio.wait_for(consume(), timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            await self.client.abort(genkey)
+            raise AsyncKoboldError(f"Generation timed out after {timeout}s")
+        
+    async def stream_content(self, task="", processed_image=None):
+        """ Yield tokens for a description as the model produces them
+        """
+        if not processed_image:
+            print("No image to describe.")
+            return
+        prompt = self.build_prompt(task)
+        if prompt is None:
+            return
+        if not isinstance(processed_image, ImagePayload):
+            processed_image = ImagePayload(processed_image)
+        async for token in self.client.stream(prompt, image=processed_image):
+            yield token
+            
+    async def close(self):
+        await self.client.close()
+        for client in self.hedge_clients:
+            await client.close()
+        
 class LLMProcessor:
+    """ Synchronous wrapper around AsyncLLMProcessor. Calls block the
+        caller while the request runs on the shared event loop.
+    """
     def __init__(self, config):
         self.api_url = config.api_url
         self.config = config
@@ -363,32 +889,71 @@ class LLMProcessor:
         self.system_instruction = config.system_instruction
         self.caption_instruction = config.caption_instruction
         config_dict = {
-            "max_length": config.gen_count,
+            "max_length": int(config.gen_count),
             "top_p": 0.95,
             "top_k": 0,
             "temp": 0.3,
             "rep_pen": 1.05,
             "min_p": 0.05,
         }
+        from koboldapi import KoboldAPICore
         self.core = KoboldAPICore(config.api_url, config.api_password, **config_dict)
+        self.engine = AsyncEngine()
+        self.async_processor = AsyncLLMProcessor(config, self.core)
 
-    def describe_content(self, task="", processed_image=None):
-        if not processed_image:
-            print("No image to describe.")
-            return None
-        if task == "caption":
-            instruction = self.caption_instruction
-        elif task == "keywords":
-            instruction = self.instruction
-        elif task == "caption_and_keywords":
-            instruction = self.instruction
-        else:
-            print(f"invalid task: {task}")
-            return None
-        return self.core.wrap_and_generate(instruction = instruction, system_instruction=self.system_instruction, images=[processed_image])
+    def describe_content(self, task="", processed_image=None, **kwargs):
+        return self.engine.run(
+            self.async_processor.describe_content(task=task, processed_image=processed_image, **kwargs)
+        )
+        
+    def close(self):
+        try:
+            self.engine.run(self.async_processor.close())
+        finally:
+            self.engine.close()
+
+class CancellationToken:
+    """ Cooperative pause and stop shared by whoever runs the indexer
+        and every stage of the pipeline. Stages check it between files,
+        so a stop lets in-flight work finish and be written instead of
+        tearing it down. Waiting while paused blocks on an event rather
+        than polling.
+    """
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+        
+    def cancel(self):
+        self._cancelled.set()
+        
+        # Wake anything waiting on a pause so it can see the stop
+        self._running.set()
+        
+    def pause(self):
+        self._running.clear()
+        
+    def resume(self):
+        self._running.set()
+        
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+        
+    @property
+    def paused(self):
+        return not self._running.is_set()
+        
+    def wait_if_paused(self, timeout=None):
+        """ Block while paused, up to timeout seconds if given. 
+            Returns True if a stop has been requested.
+        """
+        self._running.wait(timeout)
+        return self.cancelled
 
 class BackgroundIndexer(threading.Thread):
-    def __init__(self, root_dir, metadata_queue, file_extensions, no_crawl=False):
+    def __init__(self, root_dir, metadata_queue, file_extensions, no_crawl=False, skip_directory=None,
+                 cancel_token=None, budget=None, chunk_size=500):
         threading.Thread.__init__(self)
         self.root_dir = root_dir
         self.metadata_queue = metadata_queue
@@ -396,14 +961,29 @@ class BackgroundIndexer(threading.Thread):
         self.no_crawl = no_crawl
         self.total_files_found = 0
         self.indexing_complete = False
+        self.cancel_token = cancel_token or CancellationToken()
+        self.budget = budget or MemoryBudget()
+        
+        # Huge directories are queued in pieces so one batch stays small
+        self.chunk_size = chunk_size
+        
+        # Directories finished by an earlier run don't need to be listed again
+        self.skip_directory = skip_directory or (lambda directory: False)
         
     def run(self):
+        self._scan()
+        self.indexing_complete = True
+        
+    def _scan(self):
         if self.no_crawl:
-            self._index_directory(self.root_dir)
+            if not self.skip_directory(self.root_dir):
+                self._index_directory(self.root_dir)
         else:
             for root, _, _ in os.walk(self.root_dir):
-                self._index_directory(root)
-        self.indexing_complete = True
+                if self.cancel_token.wait_if_paused():
+                    break
+                if not self.skip_directory(root):
+                    self._index_directory(root)
 
     def _index_directory(self, directory):
         files = []
@@ -414,18 +994,286 @@ class BackgroundIndexer(threading.Thread):
         
         if files:
             self.total_files_found += len(files)
-            self.metadata_queue.put((directory, files))
+            for start in range(0, len(files), self.chunk_size):
+                complete = start + self.chunk_size >= len(files)
+                if not self._enqueue(directory, files[start:start + self.chunk_size], complete):
+                    return
+
+    def _enqueue(self, directory, files, complete):
+        """ Queue a batch once the scan stage has room for it. complete
+            is True for the last batch of a directory.
+        """
+        if not self.budget.acquire("scan", approx_size(files), lambda: self.cancel_token.cancelled):
+            return False
+        self.metadata_queue.put((directory, files, complete))
+        return True
+
+class WatchEventHandler(FileSystemEventHandler):
+    """ Passes file system events on to a WatchIndexer
+    """
+    def __init__(self, indexer):
+        self.indexer = indexer
+        
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        path = getattr(event, "dest_path", None) or event.src_path
+        if os.path.exists(path):
+            self.indexer.file_changed(path)
+
+class WatchIndexer(BackgroundIndexer):
+    """ Scans the tree once like BackgroundIndexer and then keeps
+        watching it, queueing new and changed images as they arrive.
+
+        Events come from watchdog when it is installed. Otherwise, or
+        with poll set for network mounts that don't deliver events, the
+        modification times of the directories are checked every
+        poll_interval seconds and only the ones that changed are listed.
+        Either way a file is only queued once its size and modification
+        time have stayed the same for settle seconds, so files still
+        being copied in are left alone.
+    """
+    def __init__(self, root_dir, metadata_queue, file_extensions, no_crawl=False, skip_directory=None,
+                 cancel_token=None, budget=None, poll=False, poll_interval=10, settle=5):
+        BackgroundIndexer.__init__(
+            self, root_dir, metadata_queue, file_extensions, no_crawl, skip_directory, cancel_token, budget
+        )
+        self.poll = poll or Observer is None
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.stopped = False
+        
+        # path -> (size, mtime) when queued or written by us
+        self.seen = {}
+        
+        # path -> ((size, mtime), time it last changed) for files settling
+        self.pending = {}
+        self.directory_mtimes = {}
+        
+        # directory -> its subdirectories when it was last listed
+        self.subdirectories = {}
+        self.lock = threading.Lock()
+        
+    def run(self):
+        observer = None
+        if not self.poll:
+            observer = Observer()
+            observer.schedule(WatchEventHandler(self), self.root_dir, recursive=not self.no_crawl)
+            observer.start()
+        try:
+            self._scan()
+            last_poll = time.time()
+            while not (self.stopped or self.cancel_token.cancelled):
+                if self.cancel_token.wait_if_paused(timeout=1):
+                    break
+                if self.poll and time.time() - last_poll >= self.poll_interval:
+                    self._poll_directories()
+                    last_poll = time.time()
+                self._queue_settled()
+                time.sleep(1)
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            self.indexing_complete = True
+            
+    def stop(self):
+        self.stopped = True
+        
+    def _stat(self, file_path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+        
+    def _is_image(self, file_path):
+        return any(file_path.lower().endswith(ext) for ext in self.file_extensions)
+        
+    def _index_directory(self, directory):
+        """ Remember what the first scan found so polling only has to
+            look at what changes after it.
+        """
+        try:
+            self.directory_mtimes[directory] = os.stat(directory).st_mtime
+        except OSError:
+            pass
+        files = []
+        subdirectories = []
+        for filename in os.listdir(directory):
+            file_path = os.path.join(directory, filename)
+            if os.path.isfile(file_path):
+                if self._is_image(file_path):
+                    self.seen[file_path] = self._stat(file_path)
+                    files.append(file_path)
+            elif os.path.isdir(file_path) and not os.path.islink(file_path):
+                subdirectories.append(file_path)
+        self.subdirectories[directory] = subdirectories
+        if files:
+            self.total_files_found += len(files)
+            for start in range(0, len(files), self.chunk_size):
+                if not self._enqueue(directory, files[start:start + self.chunk_size], False):
+                    return
+        
+    def _poll_directories(self):
+        """ Stat every directory and list only the ones whose modification
+            time changed. The subdirectories of the others are taken from
+            their last listing, so a tree where nothing changed costs one
+            stat per directory.
+        """
+        directories = [self.root_dir]
+        while directories:
+            directory = directories.pop()
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                self.directory_mtimes.pop(directory, None)
+                self.subdirectories.pop(directory, None)
+                continue
+            if self.directory_mtimes.get(directory) != mtime or directory not in self.subdirectories:
+                self.directory_mtimes[directory] = mtime
+                try:
+                    filenames = os.listdir(directory)
+                except OSError:
+                    continue
+                subdirectories = []
+                for filename in filenames:
+                    file_path = os.path.join(directory, filename)
+                    if os.path.isfile(file_path):
+                        self.file_changed(file_path)
+                    elif os.path.isdir(file_path) and not os.path.islink(file_path):
+                        subdirectories.append(file_path)
+                self.subdirectories[directory] = subdirectories
+            if not self.no_crawl:
+                directories.extend(self.subdirectories.get(directory, ()))
+        
+    def file_changed(self, file_path):
+        """ Note a new or changed file. Called from the watchdog thread
+            as well as by polling.
+        """
+        if not self._is_image(file_path):
+            return
+        if self.no_crawl and os.path.dirname(file_path) != self.root_dir.rstrip(os.sep):
+            return
+        stat = self._stat(file_path)
+        with self.lock:
+            if stat is None or self.seen.get(file_path) == stat:
+                return
+            if file_path not in self.pending or self.pending[file_path][0] != stat:
+                self.pending[file_path] = (stat, time.time())
+                
+    def file_written(self, file_path):
+        """ Our own metadata writes change the file too. Remember the
+            result so it isn't queued again.
+        """
+        with self.lock:
+            self.seen[file_path] = self._stat(file_path)
+            self.pending.pop(file_path, None)
+        
+    def _queue_settled(self):
+        now = time.time()
+        ready = {}
+        with self.lock:
+            for file_path, (stat, changed) in list(self.pending.items()):
+                current = self._stat(file_path)
+                if current is None:
+                    del self.pending[file_path]
+                elif current != stat:
+                    self.pending[file_path] = (current, now)
+                elif now - changed >= self.settle:
+                    del self.pending[file_path]
+                    self.seen[file_path] = current
+                    ready.setdefault(os.path.dirname(file_path), []).append(file_path)
+        for directory, files in ready.items():
+            self.total_files_found += len(files)
+            self._enqueue(directory, sorted(files), False)
+
+class QueuePublisher(BackgroundIndexer):
+    """ Walks the tree like BackgroundIndexer but publishes what it
+        finds to a shared WorkQueue for any worker to pick up.
+    """
+    def __init__(self, root_dir, work_queue, file_extensions, no_crawl=False, skip_directory=None, cancel_token=None):
+        BackgroundIndexer.__init__(self, root_dir, None, file_extensions, no_crawl, skip_directory, cancel_token)
+        self.work_queue = work_queue
+        
+    def run(self):
+        self.work_queue.start_scan()
+        BackgroundIndexer.run(self)
+        
+        # An interrupted scan is picked up by the next coordinator
+        if not self.cancel_token.cancelled:
+            self.work_queue.finish_scan()
+        
+    def _enqueue(self, directory, files, complete):
+        self.work_queue.publish(directory, files)
+        return True
+
+class QueueIndexer(threading.Thread):
+    """ Feeds the metadata queue with batches leased from a shared
+        WorkQueue instead of walking the tree. Keeps our leases alive
+        while they are being worked on.
+    """
+    def __init__(self, work_queue, metadata_queue, batch_size=50, cancel_token=None, budget=None):
+        threading.Thread.__init__(self)
+        self.budget = budget or MemoryBudget()
+        self.work_queue = work_queue
+        self.metadata_queue = metadata_queue
+        self.batch_size = batch_size
+        self.total_files_found = 0
+        self.indexing_complete = False
+        self.stopped = False
+        self.cancel_token = cancel_token or CancellationToken()
+        
+    def run(self):
+        last_renew = time.time()
+        try:
+            while not (self.stopped or self.cancel_token.cancelled):
+                if time.time() - last_renew > self.work_queue.lease_seconds / 3:
+                    self.work_queue.renew()
+                    last_renew = time.time()
+                
+                # Keep renewing what we hold while paused but don't take more
+                if self.cancel_token.paused:
+                    self.cancel_token.wait_if_paused(timeout=1)
+                    continue
+                    
+                # Only lease more once the last batch has been picked up
+                if not self.metadata_queue.empty():
+                    time.sleep(0.5)
+                    continue
+                    
+                directory, files = self.work_queue.lease(self.batch_size)
+                if files:
+                    self.total_files_found += len(files)
+                    
+                    # A leased batch is never the whole directory for the checkpoint
+                    self.budget.acquire("scan", approx_size(files))
+                    self.metadata_queue.put((directory, files, False))
+                elif self.work_queue.is_finished():
+                    break
+                else:
+                    time.sleep(2)
+        finally:
+            self.indexing_complete = True
+            
+    def stop(self):
+        self.stopped = True
+
 class FileProcessor:
 
-    def __init__(self, config, check_paused_or_stopped=None, callback=None):
+    def __init__(self, config, check_paused_or_stopped=None, callback=None, cancel_token=None, profiler=None):
         self.config = config
-        self.llm_processor = LLMProcessor(config)
+        self.profiler = profiler
+        
+        # Reparsing from the archive never talks to the model
+        self.llm_processor = None if config.reparse_from_archive else LLMProcessor(config)
         
         if check_paused_or_stopped is None:
 
             self.check_paused_or_stopped = lambda: False
         else:
             self.check_paused_or_stopped = check_paused_or_stopped
+        self.cancel_token = cancel_token or CancellationToken()
             
         if callback is None:
             self.callback = print
@@ -436,57 +1284,136 @@ class FileProcessor:
         self.total_processing_time = 0
         self.files_processed = 0
         self.files_completed = 0
-        # Multiples of 28 for Qwen-2-VL: 336, 448, 560, 672, 784, 980
-        self.image_processor = ImageProcessor(max_dimension=560)
+        self.progress_lock = threading.Lock()
         
-        self.et = exiftool.ExifToolHelper(check_execute=False)
+        # Batched requests only know how to ask for a caption and keywords together
+        self.batch_images = config.batch_images
+        if self.batch_images > 1 and config.detailed_caption:
+            self.callback("--batch-images doesn't work with a detailed caption, describing one image at a time")
+            self.batch_images = 1
+        self.batch_requests = 0
+        self.batch_fallbacks = 0
         
-        # Words in the prompt tend to get repeated back by certain models
-        self.banned_words = ["no", "unspecified", "unknown", "standard", "unidentified", "time", "category", "actions", "setting", "objects", "visual", "elements", "activities", "appearance", "professions", "relationships", "identify", "photography", "photographic", "topiary"]
+        # strategy -> (attempts, successes) for files that needed a retry
+        self.retry_stats = {}
+        
+        # Slow imports wait until a run actually starts, so --help and
+        # the tools that only use the helpers here start quickly
+        from llmii_image import FastImageProcessor
+        
+        # Restarted if it dies or hangs on a bad file
+        self.et = ExifToolSupervisor(
+            config.exiftool_timeout, callback=self.callback, max_hangs=config.exiftool_max_hangs, check_execute=False
+        )
+        
+        # Size, aspect handling and encoding depend on the model family
+        self.image_processor = FastImageProcessor.from_profile(config.image_profile, et=self.et)
+        
+        self.banned_words = BANNED_WORDS
                 
         # These are the fields we check. ExifTool returns are kind of strange, not always
         # conforming to where they are or what they actually are named. These should find all of them
-        self.keyword_fields = [
-            "Keywords",
-            "IPTC:Keywords",
-            "Composite:keywords",
-            "Subject",
-            "DC:Subject",
-            "XMP:Subject",
-            "XMP-dc:Subject"
-        ]
-        self.caption_fields = [
-            "Description",
-            "XMP:Description",
-            "ImageDescription",
-            "DC:Description",
-            "EXIF:ImageDescription",
-            "Composite:Description",
-            "Caption",
-            "IPTC:Caption",
-            "Composite:Caption"
-            "IPTC:Caption-Abstract",
-            "XMP-dc:Description",
-            "PNG:Description"
-        ]
-
-        self.identifier_fields = [
-            "Identifier",
-            "XMP:Identifier",            
-        ]
-        self.status_fields = [
-            "Status",
-            "XMP:Status"
-        ]
+        self.keyword_fields = KEYWORD_FIELDS
+        self.caption_fields = CAPTION_FIELDS
+        self.identifier_fields = IDENTIFIER_FIELDS
+        self.status_fields = STATUS_FIELDS
+        self.field_lookup = FIELD_LOOKUP
         
         self.image_extensions = config.image_extensions
-        self.metadata_queue = queue.Queue()
-        self.indexer = BackgroundIndexer(
-            config.directory, 
-            self.metadata_queue, 
-            [ext for exts in self.image_extensions.values() for ext in exts], 
-            config.no_crawl
-        )
+        self.metadata_queue = ScheduledQueue(config.schedule, config.priority_dirs)
+        
+        # Paths held back by failed_last until everything else is done.
+        # Only the paths are kept, so a long run doesn't hold records
+        # outside the memory budget, and they are read again at the end.
+        self.deferred = []
+        self.deferred_directories = set()
+        self.deferred_complete = set()
+        
+        # directory -> its files without a journaled result so far. Only
+        # a directory with none left is journaled as done, so a resumed
+        # run still retries errors and files ExifTool couldn't read.
+        self.unjournaled = {}
+        file_extensions = [ext for exts in self.image_extensions.values() for ext in exts]
+        
+        # Caps what the scan, metadata and image stages hold at once
+        max_buffer = config.max_buffer_mb * 1048576 if config.max_buffer_mb else None
+        self.budget = MemoryBudget(max_buffer)
+        
+        # Room for one decoded image and its payload while it is in flight
+        self.image_reserve = (2 * self.image_processor.max_dimension) ** 2 * 3
+        
+        # Shared keyword strings, and their counts if there is a file for them
+        self.vocabulary = KeywordVocabulary(config.vocabulary)
+        self.search_index = SearchIndex(config.index) if config.index else None
+        self.archive = None
+        if config.archive and not config.reparse_from_archive:
+            self.archive = ResponseArchive(config.archive)
+        
+        self.checkpoint = None
+        skip_directory = None
+        if config.checkpoint:
+            self.checkpoint = CheckpointJournal(config.checkpoint, resume=config.resume)
+            skip_directory = self.checkpoint.is_directory_done
+            if config.resume:
+                self.callback(
+                    f"Resuming: {len(self.checkpoint.completed_files)} files and "
+                    f"{len(self.checkpoint.completed_directories)} directories already done"
+                )
+        elif config.resume:
+            self.callback("Nothing to resume from: --resume needs a --checkpoint journal")
+        
+        # With a shared work queue the tree is scanned by the coordinator
+        # and every process, coordinator included, works from leases
+        self.work_queue = None
+        self.publisher = None
+        self.indexer = None
+        
+        # Reparsing works from the archive instead of scanning the tree
+        if config.reparse_from_archive:
+            return
+        if config.watch and config.work_queue:
+            self.callback("--watch can't be used with --work-queue, the tree will be scanned once")
+            config.watch = False
+        if config.work_queue:
+            self.work_queue = WorkQueue(
+                config.work_queue, config.directory, lease_seconds=config.lease_seconds
+            )
+            if config.coordinator:
+                self.publisher = QueuePublisher(
+                    config.directory, self.work_queue, file_extensions, config.no_crawl,
+                    skip_directory, self.cancel_token
+                )
+                self.publisher.start()
+            self.indexer = QueueIndexer(
+                self.work_queue, self.metadata_queue, config.queue_batch_size, self.cancel_token, self.budget
+            )
+        elif config.watch:
+        
+            # Directories stay open while watching so none are journaled as done
+            self.indexer = WatchIndexer(
+                config.directory,
+                self.metadata_queue,
+                file_extensions,
+                config.no_crawl,
+                skip_directory,
+                self.cancel_token,
+                self.budget,
+                config.watch_poll,
+                config.watch_interval,
+                config.watch_settle
+            )
+            mode = "polling" if self.indexer.poll else "file system events"
+            self.callback(f"Watching {config.directory} for new images using {mode}")
+        else:
+            self.indexer = BackgroundIndexer(
+                config.directory, 
+                self.metadata_queue, 
+                file_extensions, 
+                config.no_crawl,
+                skip_directory,
+                self.cancel_token,
+                self.budget
+            )
         self.indexer.start()
         
     def get_file_type(self, file_ext):
@@ -502,33 +1429,32 @@ class FileProcessor:
                 return file_type
         return None
 
-    def check_uuid(self, metadata, file_path):
+    def check_uuid(self, record):
         """ Very important or we end up processing 
             files more than once
         """ 
         try:
 
-            status = metadata.get("XMP:Status")
-            identifier = metadata.get("XMP:Identifier")
-            keywords = metadata.get("MWG:Keywords")
-            caption = metadata.get("MWG:Description")
+            status = record.status
+            identifier = record.identifier
+            keywords = record.keywords
             
             if identifier and self.config.reprocess_orphans:
                 if not status:
                     if keywords:
-                        metadata["XMP:Status"] = "success"
+                        record.status = "success"
                     
                     if not keywords:
-                        metadata["XMP:Status"] = "failed" 
+                        record.status = "failed" 
                 
                     try:
-                        written = self.write_metadata(file_path, metadata)
+                        written = self.write_metadata(record)
                         if written:
-                            print(f"Status added for orphan: {file_path}")  
-                            self.callback(f"Status added for orphan: {file_path}")
+                            print(f"Status added for orphan: {record.path}")  
+                            self.callback(f"Status added for orphan: {record.path}")
                         else:
-                            print(f"Metadata write error for orphan: {file_path}")
-                            self.callback(f"Metadata write error for orphan: {file_path}")
+                            print(f"Metadata write error for orphan: {record.path}")
+                            self.callback(f"Metadata write error for orphan: {record.path}")
                     except:
                         print("Error writing orphan status")
             # Does file have a UUID in metadata
@@ -539,41 +1465,53 @@ class FileProcessor:
                     
                 # If it is retry, do it again
                 if self.config.reprocess_all or status == "retry":
-                    metadata["XMP:Status"] = None
-                    return metadata
+                    record.status = None
+                    return record
                 
                 # If it is fail, don't do it unless we specifically want to
                 if status == "failed":
                     if self.config.reprocess_failed or self.config.reprocess_all:
-                        metadata["XMP:Status"] = None
-                        return metadata                    
+                        record.status = None
+                        return record                    
                     else:
                         return None
                 
                 # If there are no keywords, processs it                
                 if not keywords:
-                    metadata["XMP:Status"] = None
-                    return metadata
+                    record.status = None
+                    return record
                 
                 else:
                     return None
                 
             # No UUID, treat as new file
             else:
-                metadata["XMP:Identifier"] = str(uuid.uuid4())
-                return metadata  # New file
+                record.identifier = str(uuid.uuid4())
+                return record  # New file
 
         except Exception as e:
             print(f"Error checking UUID: {str(e)}")
             return None
                         
     def check_pause_stop(self):
+        """ Called between files. Blocks while paused and returns True
+            once a stop has been requested.
+        """
+        if self.cancel_token.wait_if_paused():
+            return True
         if self.check_paused_or_stopped():
             while self.check_paused_or_stopped():
                 time.sleep(0.1)
             if self.check_paused_or_stopped():
                 return True
         return False
+        
+    async def check_pause_stop_async(self):
+        """ check_pause_stop without blocking the event loop, so 
+            generations already in flight can finish while paused.
+        """
+        import asyncio
+        return await asyncio.to_thread(self.check_pause_stop)
 
     def list_files(self, directory):
         files = []
@@ -596,192 +1534,632 @@ class FileProcessor:
                     return
                 
                 try:
-                    directory, files = self.metadata_queue.get(timeout=1)
+                    files = None
+                    unread = set()
+                    metadata_bytes = 0
+                    directory, files, directory_complete = self.metadata_queue.get(timeout=1)
+                    self.budget.release("scan", approx_size(files))
                     self.callback(f"Processing directory: {directory}")
-                    metadata_list = self._get_metadata_batch(files)
+                    if self.checkpoint is not None:
+                        done = [f for f in files if self.checkpoint.is_file_done(f)]
+                        if done:
+                            self.files_processed += len(done)
+                            for file_path in done:
+                                self.report_result(file_path, "skipped")
+                            files = [f for f in files if not self.checkpoint.is_file_done(f)]
+                    metadata_list = self._get_metadata_batch(files) if files else []
+                    records = [self.standardize_metadata(m) for m in metadata_list if m]
+                    del metadata_list
                     
-                    for metadata in metadata_list:
-                                
-
-                        if metadata:
-                            if not self.config.skip_verify:
-                                # Check if ExifTool returned any Warnings or Errors. It comes as value "0 0 0"
-                                # for number of errors warnings and minor warnings
-                                if "ExifTool:Validate" in metadata:
-                                    errors, warnings, minor = map(int, metadata.get("ExifTool:Validate", "0 0 0").split())
-                                    source_file = metadata.get("SourceFile")
-                                    if errors > 0:
-                                        print(f"{source_file}: failed to validate. Skipping!")
-                                        self.callback(f"\n{source_file}: failed to validate. Skipping!")
-                                        self.files_processed +=1
-                                        continue
-                                                       
-                            keywords = []
-                            status = None
-                            identifier = None
-                            caption = None
-                            
-                            # Make a copy with only the fields we want to write
-                            new_metadata = {}
-                            new_metadata["SourceFile"] = metadata.get("SourceFile")
-                            
-                            for key, value in metadata.items():
-                            
-                                # Collect all keywords
-                                if key in self.keyword_fields:
-                                    keywords.extend(value)
-                            
-                                # Ignore any duplicate captions
-                                if key in self.caption_fields:
-                                    caption = value
-                              
-                                # Processing fields
-                                if key in self.identifier_fields:
-                                    identifier = value
-                                if key in self.status_fields:
-                                    status = value
-                                    
-                            # Standardize the fields                             
-                            if keywords:
-                                new_metadata["MWG:Keywords"] = keywords
-                            if caption:
-                                new_metadata["MWG:Description"] = caption
-                            if status:
-                                new_metadata["XMP:Status"] = status
-                            if identifier:
-                                new_metadata["XMP:Identifier"] = identifier
-                            self.files_processed += 1
-                            self.process_file(new_metadata)
-
+                    # ExifTool may give paths back with other separators
+                    read = {os.path.normcase(os.path.abspath(record.path)) for record in records}
+                    unread = {f for f in files if os.path.normcase(os.path.abspath(f)) not in read}
+                    metadata_bytes = approx_size(records)
+                    self.budget.acquire("metadata", metadata_bytes)
+                    
+                    # Only files that are going to be touched pay for a full validation
+                    invalid = set()
+                    if not self.config.skip_verify:
+                        invalid = self._validate_batch(
+                            [r.path for r in records if self.needs_validation(r)]
+                        )
+                    valid = []
+                    for record in records:
+                        source_file = record.path
+                        if source_file in invalid:
+                            print(f"{source_file}: failed to validate. Skipping!")
+                            self.callback(f"\n{source_file}: failed to validate. Skipping!")
+                            self.files_processed +=1
+                            self.report_result(source_file, "invalid")
+                            continue
+                        valid.append(record)
+                        
+                    # Files that failed before are the least likely to work so they wait
+                    if self.config.failed_last:
+                        failed = [r for r in valid if r.status == "failed"]
+                        if failed and self.work_queue is None:
+                            self.deferred.extend(r.path for r in failed)
+                            self.deferred_directories.add(directory)
+                            valid = [r for r in valid if r.status != "failed"]
+                        else:
+                            valid.sort(key=lambda r: r.status == "failed")
                             
-                        if self.check_pause_stop():
-                            return
+                    if self.process_records(valid):
+                        return
                     
+                    if self.checkpoint is not None:
+                        missing = self.unjournaled.setdefault(directory, set())
+                        missing.update(f for f in files if not self.checkpoint.is_file_done(f))
+                        if directory_complete:
+                            if directory in self.deferred_directories:
+                                self.deferred_complete.add(directory)
+                            elif not self.unjournaled.pop(directory):
+                                self.checkpoint.directory_done(directory)
+                    self.vocabulary.save()
+                    if self.search_index is not None:
+                        self.search_index.commit()
+                    if self.archive is not None:
+                        self.archive.flush()
+                        
                     self.update_progress()
                     
                 except queue.Empty:
                     continue
+                finally:
+                    self.budget.release("metadata", metadata_bytes)
+                    # Anything from this batch without a result goes back to the 
+                    # queue. Files ExifTool couldn't read keep their attempt, so
+                    # one that breaks ExifTool runs out of them instead of coming
+                    # back forever.
+                    if self.work_queue is not None and files:
+                        self.work_queue.release([f for f in files if f not in unread])
+                        self.work_queue.release(unread, refund=False)
+                        
+            if self.deferred:
+                self.callback(f"Processing {len(self.deferred)} files that failed before")
+                if self.process_deferred():
+                    return
+                if self.checkpoint is not None:
+                    for directory in self.deferred_complete:
+                        missing = self.unjournaled.pop(directory, ())
+                        if all(self.checkpoint.is_file_done(f) for f in missing):
+                            self.checkpoint.directory_done(directory)
+                self.update_progress()
         finally:
+            self.close()
+            
+    def process_deferred(self):
+        """ Read the files held back by failed_last again and process
+            them a batch at a time. Returns True if a stop was requested.
+        """
+        size = self.config.queue_batch_size
+        for start in range(0, len(self.deferred), size):
+            metadata_list = self._get_metadata_batch(self.deferred[start:start + size])
+            records = [self.standardize_metadata(m) for m in metadata_list if m]
+            del metadata_list
+            metadata_bytes = approx_size(records)
+            self.budget.acquire("metadata", metadata_bytes)
             try:
-                self.et.terminate()
-                self.callback("ExifTool process terminated cleanly")
-            except Exception as e:
-                self.callback(f"Warning: ExifTool termination error: {str(e)}")
+                if self.process_records(records):
+                    return True
+            finally:
+                self.budget.release("metadata", metadata_bytes)
+        return False
+        
+    def close(self):
+        """ Stop the indexer and flush and close everything the run 
+            opened.
+        """
+        if self.work_queue is not None or self.config.watch:
+            self.indexer.stop()
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        try:
+            self.vocabulary.save()
+        except Exception as e:
+            self.callback(f"Warning: could not save keyword vocabulary: {str(e)}")
+        if self.search_index is not None:
+            self.search_index.close()
+        if self.archive is not None:
+            self.archive.close()
+        try:
+            if self.llm_processor is not None:
+                self.llm_processor.close()
+        except Exception as e:
+            self.callback(f"Warning: LLM client shutdown error: {str(e)}")
+        try:
+            self.et.terminate()
+            self.callback("ExifTool process terminated cleanly")
+        except Exception as e:
+            self.callback(f"Warning: ExifTool termination error: {str(e)}")
+            
+    def reparse_archive(self):
+        """ Work out keywords and captions again from the archived model
+            responses with the current parsing and normalization, and
+            write the files where they changed. Nothing is generated.
+            A file is only touched if it still has the identifier it was
+            archived under.
+        """
+        archive = ResponseArchive(self.config.archive)
+        counts = {"reparsed": 0, "changed": 0, "missing": 0, "unusable": 0}
+        batch = []
+        try:
+            for entry in archive.latest():
+                if self.check_pause_stop():
+                    return
+                if not os.path.exists(entry.get("path") or ""):
+                    counts["missing"] += 1
+                    continue
+                batch.append(entry)
+                if len(batch) >= 100:
+                    self._reparse_batch(batch, counts)
+                    batch = []
+            if batch:
+                self._reparse_batch(batch, counts)
+            self.callback(
+                f"Reparsed {counts['reparsed']} files from the archive, {counts['changed']} changed. "
+                f"Not found: {counts['missing']}, no usable keywords: {counts['unusable']}"
+            )
+        finally:
+            self.close()
+            
+    def _reparse_batch(self, entries, counts):
+        on_file = {}
+        for metadata in self._get_metadata_batch([entry["path"] for entry in entries]):
+            record = self.standardize_metadata(metadata)
+            on_file[os.path.abspath(record.path)] = record
+            
+        for entry in entries:
+            current = on_file.get(entry["path"])
+            if current is None or current.identifier != entry["id"]:
+                counts["missing"] += 1
+                continue
+                
+            # Start from what the file had before it was first generated for
+            existing = entry.get("existing") or {}
+            record = FileRecord(
+                entry["path"], identifier=entry["id"],
+                keywords=existing.get("keywords"), caption=existing.get("caption")
+            )
+            if "batch_response" in entry:
+                item = split_batch_response(entry["batch_response"], entry["batch_count"]).get(entry["position"])
+                if item is None:
+                    counts["unusable"] += 1
+                    continue
+                record.responses = {"caption_and_keywords": item}
+            elif "responses" in entry:
+                record.responses = entry["responses"]
+            else:
+                counts["unusable"] += 1
+                continue
+            self.parse_generation(record, record.responses)
+            if record.status != "success" and not self._try_reparse(record):
+                counts["unusable"] += 1
+                continue
+            counts["reparsed"] += 1
+            
+            if (current.status == "success" and set(record.keywords) == set(current.keywords) 
+                    and record.caption == current.caption):
+                continue
+            if self.write_metadata(record):
+                counts["changed"] += 1
+                if self.search_index is not None:
+                    self.search_index.update(record)
+        if self.search_index is not None:
+            self.search_index.commit()
 
+    def process_records(self, records):
+        """ Generate and write metadata for validated records. Returns
+            True if a stop was requested.
+        """
+        pending = []
+        for record in records:
+            self.files_processed += 1
+            
+            # Concurrent and batched modes generate the whole batch at once below
+            if self.config.concurrency > 1 or self.batch_images > 1:
+                pending.append(record)
+                continue
+                
+            status = self.process_file(record)
+            self.report_result(record.path, status)
+                
+            if self.check_pause_stop():
+                return True
+        
+        if pending:
+            self.llm_processor.engine.run(self.process_files_async(pending))
+            if self.check_pause_stop():
+                return True
+        return False
+        
+    def standardize_metadata(self, metadata):
+        """ Collapse whatever fields ExifTool returned into the 
+            FileRecord that carries the file through the pipeline.
+        """
+        return FileRecord.from_exiftool(metadata, self.field_lookup)
+        
+    def needs_validation(self, record):
+        """ True if check_uuid would generate for this file or write an
+            orphan status to it. Mirrors check_uuid without touching the
+            record, so files about to be skipped are never validated.
+        """
+        status = record.status
+        if not record.identifier:
+            return True
+        if self.config.reprocess_all or status == "retry":
+            return True
+        if self.config.reprocess_orphans and not status:
+            return True
+        if status == "success":
+            return False
+        if status == "failed":
+            return self.config.reprocess_failed
+        return not record.keywords
+        
     def _get_metadata_batch(self, files):
-        """Get metadata for a batch of files using persistent ExifTool instance"""
+        """ Get metadata for a batch of files using persistent ExifTool
+            instance. This only reads the tags, validation is done 
+            separately for the files that need it.
+        """
         exiftool_fields = self.keyword_fields + self.caption_fields + self.identifier_fields + self.status_fields 
         
         try:
-            if self.config.skip_verify:
-                params = []
-            else:
-                params = ["-validate"]   
-            return self.et.get_tags(files, tags=exiftool_fields, params=params)
+            return self.et.get_tags(files, tags=exiftool_fields)
             
+        except ExifToolGaveUp as e:
+            self._exiftool_gave_up(e)
+            return []
         except Exception as e:
             print("Exiftool error")
             return []
+            
+    def _exiftool_gave_up(self, error):
+        """ ExifTool won't be started again, so no file can be read or
+            written any more. Stop the run instead of failing every file
+            left in the tree.
+        """
+        if not self.cancel_token.cancelled:
+            self.callback(f"\nStopping: {str(error)}. Allow more with --exiftool-max-hangs.")
+            self.cancel_token.cancel()
+            
+    def _validate_batch(self, files):
+        """ Run ExifTool's full structure validation. Returns the set of
+            files that have errors.
+        """
+        invalid = set()
+        if not files:
+            return invalid
+        try:
+            results = self.et.get_tags(files, tags=["Validate"], params=["-validate"])
+        except ExifToolGaveUp as e:
+            self._exiftool_gave_up(e)
+            return invalid
+        except Exception as e:
+            print("Exiftool error")
+            return invalid
+            
+        # Validate comes back as "errors warnings minor_warnings"
+        for result in results:
+            if "ExifTool:Validate" in result:
+                errors, warnings, minor = map(int, result.get("ExifTool:Validate", "0 0 0").split())
+                if errors > 0:
+                    invalid.add(result.get("SourceFile"))
+        return invalid
 
+    def report_result(self, file_path, status):
+        """ Record the final result of a file in the checkpoint journal
+            and mark it done in the shared work queue. Errors are not
+            journaled so a resumed run tries those files again.
+        """
+        status = status or "skipped"
+        if self.profiler is not None:
+            self.profiler.file_done()
+        
+        # Never started, so it stays pending for a resumed run or another worker
+        if status == "cancelled":
+            return
+        if self.checkpoint is not None and status != "error" and not self.checkpoint.is_file_done(file_path):
+            self.checkpoint.file_done(file_path, status)
+        if self.work_queue is None:
+            return
+        try:
+            self.work_queue.complete(file_path, status)
+        except Exception as e:
+            self.callback(f"Work queue error for {file_path}: {str(e)}")
+            
     def update_progress(self):
         files_processed = self.files_processed
         files_remaining = self.indexer.total_files_found - files_processed
         if files_remaining < 0:
             files_remaining = 0
         self.callback(f"Directory processed. Files remaining in queue: {files_remaining}")
+        self.callback(self.budget.report())
+        stats = self.llm_processor.async_processor.stats if self.llm_processor else {}
+        if any(stats.values()):
+            self.callback(
+                f"Timed out: {stats['timeouts']}, hedged: {stats['hedged']}, won by the hedge: {stats['hedge_wins']}"
+            )
+        if self.retry_stats:
+            self.callback("Retries: " + ", ".join(
+                f"{strategy} {successes}/{attempts}" for strategy, (attempts, successes) in self.retry_stats.items()
+            ))
+        if any(self.et.stats.values()):
+            self.callback(self.et.report())
+        if self.batch_requests:
+            self.callback(
+                f"Batched requests: {self.batch_requests}, files generated on their own after a batch: {self.batch_fallbacks}"
+            )
         
-    def process_file(self, metadata):
+    def process_file(self, record):
         """ Process a single file and update its metadata in one operation.
             This minimizes the number of writes to the file.
         """
+        file_path = record.path
+        self.budget.acquire("images", self.image_reserve)
         try:    
-            file_path = metadata["SourceFile"]
+            prepared = self.prepare_file(record)
+            if prepared is None:
+                return None
+            record, processed_image = prepared
             
-            # If the file doesn't exist anymore, skip it
-            if not os.path.exists(file_path):
-                self.callback(f"File no longer exists: {file_path}")
-                return
+            self.generate_metadata(record, processed_image)
             
-            # Check UUID and status
-            metadata = self.check_uuid(metadata, file_path)
-            if not metadata:
-                return
+            if record.status == "retry":
+                print(f"Retrying {file_path}")
+                self.llm_processor.engine.run(self.recover_async(record, processed_image))
                 
-            image_type = self.get_file_type(os.path.splitext(file_path)[1].lower())
-            if image_type is None:
-                self.callback(f"Not a supported image type: {file_path}")
-                return
+            return self.finish_file(record)
+            
+        except Exception as e:
+            self.callback(f"\nError processing: {file_path}: {str(e)}")
+
+            
+            return "error"
+        finally:
+            self.budget.release("images", self.image_reserve)
+            
+    async def process_file_async(self, record):
+        """ Same as process_file but awaits the generations so other
+            files can be generated at the same time.
+        """
+        import asyncio
+        file_path = record.path
+        if not await self.budget.acquire_async(
+            "images", self.image_reserve, lambda: self.cancel_token.cancelled
+        ):
+            return "cancelled"
+        try:    
+            
+            # Reading metadata, resizing and writing block, so they run
+            # in threads and leave the loop to the generations
+            prepared = await asyncio.to_thread(self.prepare_file, record)
+            if prepared is None:
+                return None
+            return await self.generate_and_finish_async(*prepared)
+            
+        except Exception as e:
+            self.callback(f"\nError processing: {file_path}: {str(e)}")
+            return "error"
+        finally:
+            self.budget.release("images", self.image_reserve)
+            
+    async def generate_and_finish_async(self, record, processed_image):
+        """ Generate for one prepared file, retrying once if allowed, and
+            write the result.
+        """
+        import asyncio
+        await self.generate_metadata_async(record, processed_image)
+        
+        if record.status == "retry":
+            print(f"Retrying {record.path}")
+            await self.recover_async(record, processed_image)
+            
+        return await asyncio.to_thread(self.finish_file, record)
+            
+    async def process_batch_async(self, records):
+        """ Generate for several files with one request. Any file whose
+            entry in the answer is missing or unusable is generated on
+            its own. Returns {path: status}.
+        """
+        import asyncio
+        reserve = self.image_reserve * len(records)
+        if not await self.budget.acquire_async(
+            "images", reserve, lambda: self.cancel_token.cancelled
+        ):
+            return {record.path: "cancelled" for record in records}
+        results = {}
+        try:
+            prepared = []
+            for record in records:
+                try:
+                    item = await asyncio.to_thread(self.prepare_file, record)
+                except Exception as e:
+                    self.callback(f"\nError processing: {record.path}: {str(e)}")
+                    results[record.path] = "error"
+                    continue
+                if item is None:
+                    results[record.path] = None
+                else:
+                    prepared.append(item)
+                    
+            entries = {}
+            batch = [item for item in prepared if item[1]]
+            if len(batch) > 1:
+                self.batch_requests += 1
+                try:
+                    response = await self.llm_processor.async_processor.describe_batch(
+                        [image for _, image in batch]
+                    )
+                    entries = split_batch_response(response, len(batch))
+                except Exception as e:
+                    self.callback(f"Batch generation failed, describing one image at a time: {str(e)}")
+                    
+            # The raw answer is archived once and its files point into it,
+            # so a reparse splits it again with the parser of the day
+            batch_id = None
+            if entries and self.archive is not None:
+                batch_id = await asyncio.to_thread(self.archive.append_batch, response, len(batch))
                 
-            # Process the file
-            start_time = time.time()
-            processed_image, image_path = self.image_processor.process_image(file_path)
-            updated_metadata = self.generate_metadata(metadata, processed_image)
-           
-            status = updated_metadata.get("XMP:Status")
-            
-            # Retry one time if failed
-            if not self.config.quick_fail and status == "retry":
-                print(f"Retrying {file_path} once")
-                updated_metadata = self.generate_metadata(metadata, processed_image)      
-                status = updated_metadata.get("XMP:Status")
-            
-            # If retry didn't work, mark failed
-            if not status == "success":
-                metadata["XMP:Status"] = "failed"
-                if not self.config.dry_run:
-                    self.write_metadata(file_path, metadata)
-                return
+            single = []
+            for record, image in prepared:
+                position = next((i for i, item in enumerate(batch) if item[0] is record), None)
+                entry = entries.get(position)
+                if entry is not None:
+                    record.responses = {"caption_and_keywords": entry}
+                    self.parse_generation(record, record.responses)
+                    if record.status == "success":
+                        if batch_id is not None:
+                            record.batch = (batch_id, position)
+                        results[record.path] = await asyncio.to_thread(self.finish_file, record)
+                        continue
+                if len(batch) > 1:
+                    self.batch_fallbacks += 1
+                single.append((record, image))
                 
-            if not self.config.dry_run:
-                self.write_metadata(file_path, updated_metadata)
+            async def finish_single(record, image):
+                try:
+                    results[record.path] = await self.generate_and_finish_async(record, image)
+                except Exception as e:
+                    self.callback(f"\nError processing: {record.path}: {str(e)}")
+                    results[record.path] = "error"
+                    
+            await asyncio.gather(*(finish_single(record, image) for record, image in single))
+            return results
+        finally:
+            self.budget.release("images", reserve)
+            
+    async def process_files_async(self, records):
+        """ Process a batch of files keeping up to config.concurrency
+            generations in flight on the event loop. With batch_images
+            set, each generation describes that many files.
+        """
+        import asyncio
+        semaphore = asyncio.Semaphore(self.config.concurrency)
+        size = max(self.batch_images, 1)
+        
+        async def run(group):
+            async with semaphore:
+                if await self.check_pause_stop_async():
+                    return
+                if len(group) == 1:
+                    results = {group[0].path: await self.process_file_async(group[0])}
+                else:
+                    results = await self.process_batch_async(group)
+                for record in group:
+                    await asyncio.to_thread(self.report_result, record.path, results.get(record.path))
                 
-            print(f"{file_path}: {status}")
-            end_time = time.time()
-            processing_time = end_time - start_time
-            self.total_processing_time += processing_time
-            self.files_completed += 1
+        groups = [records[i:i + size] for i in range(0, len(records), size)]
+        await asyncio.gather(*(run(group) for group in groups))
+        
+    def prepare_file(self, record):
+        """ Everything that happens before generation. Returns 
+            (record, processed_image) or None if the file should be
+            skipped.
+        """
+        file_path = record.path
+        
+        # If the file doesn't exist anymore, skip it
+        if not os.path.exists(file_path):
+            self.callback(f"File no longer exists: {file_path}")
+            return None
+        
+        # Check UUID and status
+        checked = self.check_uuid(record)
+        if not checked:
+        
+            # Files tagged before the index existed are added as we pass them
+            if self.search_index is not None and record.status == "success" and record.keywords:
+                self.search_index.update(record)
+            return None
+        record = checked
             
-            # Calculate and display progress info
-            in_queue = self.indexer.total_files_found - self.files_processed
-            average_time = self.total_processing_time / self.files_completed
-            time_left = average_time * in_queue
-            time_left_unit = "s"
+        image_type = self.get_file_type(os.path.splitext(file_path)[1].lower())
+        if image_type is None:
+            self.callback(f"Not a supported image type: {file_path}")
+            return None
             
-            if time_left > 180:
-                time_left = time_left / 60
-                time_left_unit = "mins"
+        # Process the file. The request body for the image is built once
+        # here and reused by every generation for this file
+        record.started = time.time()
+        processed_image, image_path = self.image_processor.process_image(file_path)
+        if processed_image:
+            processed_image = ImagePayload(processed_image)
+        return record, processed_image
+        
+    def finish_file(self, record):
+        """ Write the results of generation and report progress.
+            Returns the final status.
+        """
+        file_path = record.path
+        status = record.status
+        
+        if self.archive is not None:
+            self.archive.append(record, record.original)
             
-            if time_left < 0:
-                time_left = 0
+        # If retry didn't work, mark failed
+        if not status == "success":
+            record.status = "failed"
+            if not self.config.dry_run:
+                self.write_metadata(record)
+            return "failed"
             
-            if in_queue < 0:
-                in_queue = 0
-            if status == "success":
-                self.callback("")    
-                self.callback(f"<b>Image:</b> {os.path.basename(file_path)}, <b>Status:</b> {status}")
-                
-                if updated_metadata.get("MWG:Description"):
-                    self.callback(f"<b>Caption:</b> {updated_metadata.get('MWG:Description')}") 
-                    self.callback(f"<b>Keywords:</b> {updated_metadata.get('MWG:Keywords', '')}")
-
-                self.callback(
-                    f"Processing time: {processing_time:.2f}s Average processing time: {average_time:.2f}s"
-                )
-                self.callback(
-                    f"Processed: {self.files_processed}, In queue: {in_queue}, Time remaining (est): {time_left:.2f}{time_left_unit}"
-                )
-            if self.check_pause_stop():
-                return
+        if not self.config.dry_run:
+            if self.write_metadata(record):
+                self.vocabulary.add(record.keywords)
+                if self.search_index is not None:
+                    self.search_index.update(record)
             
-        except Exception as e:
-            self.callback(f"\nError processing: {file_path}: {str(e)}")
-
+        print(f"{file_path}: {status}")
+        record.elapsed = time.time() - record.started
+        processing_time = record.elapsed
+        
+        # Files are finished in several threads when running async
+        with self.progress_lock:
+            self.total_processing_time += processing_time
+            self.files_completed += 1
+            average_time = self.total_processing_time / self.files_completed
+        
+        # Calculate and display progress info
+        in_queue = self.indexer.total_files_found - self.files_processed
+        time_left = average_time * in_queue
+        time_left_unit = "s"
+        
+        if time_left > 180:
+            time_left = time_left / 60
+            time_left_unit = "mins"
+        
+        if time_left < 0:
+            time_left = 0
+        
+        if in_queue < 0:
+            in_queue = 0
+        if status == "success":
+            self.callback("")    
+            self.callback(f"<b>Image:</b> {os.path.basename(file_path)}, <b>Status:</b> {status}")
             
-            return
+            if record.caption:
+                self.callback(f"<b>Caption:</b> {record.caption}") 
+                self.callback(f"<b>Keywords:</b> {list(record.keywords)}")
+
+            self.callback(
+                f"Processing time: {processing_time:.2f}s Average processing time: {average_time:.2f}s"
+            )
+            self.callback(
+                f"Processed: {self.files_processed}, In queue: {in_queue}, Time remaining (est): {time_left:.2f}{time_left_unit}"
+            )
+        return status
     
-    def generate_metadata(self, metadata, processed_image):
-        """ Generate metadata without writing to file.
-            Returns (metadata_dict)
+    def generation_tasks(self):
+        """ The describe_content tasks needed for one file
+        """
+        if not self.config.no_caption and self.config.detailed_caption:
+            return ["keywords", "caption"]
+        return ["caption_and_keywords"]
+        
+    def generate_metadata(self, record, processed_image):
+        """ Generate metadata without writing to file. Fills in the
+            record and returns it.
             
             short_caption will get a short caption in a single generation
             
@@ -791,19 +2169,110 @@ class FileProcessor:
             update_caption appends new caption to existing caption to the existing description.
             
         """
-        new_metadata = {}
-       
-        existing_caption = metadata.get("MWG:Description")
+        try:
+            responses = {}
+            for task in self.generation_tasks():
+                responses[task] = self.llm_processor.describe_content(task=task, processed_image=processed_image)
+        except Exception as e:
+            return self._generation_failed(record, e)
+        record.responses = responses
+        return self.parse_generation(record, responses)
+        
+    async def generate_metadata_async(self, record, processed_image, **kwargs):
+        """ Async generate_metadata. With a detailed caption both
+            generations run at the same time. kwargs override the
+            generation parameters.
+        """
+        import asyncio
+        tasks = self.generation_tasks()
+        try:
+            results = await asyncio.gather(*(
+                self.llm_processor.async_processor.describe_content(task=task, processed_image=processed_image, **kwargs)
+                for task in tasks
+            ))
+        except Exception as e:
+            return self._generation_failed(record, e)
+        record.responses = dict(zip(tasks, results))
+        return self.parse_generation(record, record.responses)
+        
+    async def recover_async(self, record, processed_image):
+        """ Try to rescue a file whose generation gave no usable 
+            keywords, cheapest strategy first, and count how often each
+            strategy works.
+            
+              reparse  - look at the raw text again with relaxed parsing,
+                         costs no generation
+              continue - let the model finish a response that stopped
+                         inside its JSON
+              resample - generate again with a higher temperature and a
+                         new seed, so the same failure isn't repeated
+                         
+            Up to config.retry_generations generations are spent, none 
+            with quick_fail.
+        """
+        if record.responses and self._try_reparse(record):
+            return record
+        generations = 0 if self.config.quick_fail else self.config.retry_generations
+        for _ in range(generations):
+            responses = record.responses or {}
+            truncated = [task for task, text in responses.items() if looks_truncated(text)]
+            if truncated:
+                strategy = "continue"
+                try:
+                    for task in truncated:
+                        responses[task] = await self.llm_processor.async_processor.continue_content(
+                            task, processed_image, responses[task]
+                        )
+                    self.parse_generation(record, responses)
+                except Exception as e:
+                    self._generation_failed(record, e)
+            else:
+                strategy = "resample"
+                await self.generate_metadata_async(
+                    record, processed_image,
+                    temp=self.config.retry_temperature, sampler_seed=random.randint(1, 2**31 - 1)
+                )
+            self._count_retry(strategy, record.status == "success")
+            if record.status == "success":
+                break
+            if record.responses and self._try_reparse(record):
+                break
+        return record
+        
+    def _try_reparse(self, record):
+        responses = dict(record.responses)
+        task = "keywords" if "keywords" in responses else "caption_and_keywords"
+        parsed = relaxed_parse(responses.get(task))
+        if parsed is not None:
+            responses[task] = parsed
+            self.parse_generation(record, responses)
+        success = parsed is not None and record.status == "success"
+        self._count_retry("reparse", success)
+        return success
+        
+    def _count_retry(self, strategy, success):
+        attempts, successes = self.retry_stats.get(strategy, (0, 0))
+        self.retry_stats[strategy] = (attempts + 1, successes + int(success))
+        
+    def _generation_failed(self, record, e):
+        self.callback(f"Parse error for {record.path}: {str(e)}")
+        record.status = "retry"
+        return record
+        
+    def parse_generation(self, record, responses):
+        """ Turn the raw model responses for each task into the
+            caption and keywords to write. The record only takes them
+            if generation succeeded.
+        """
+        existing_caption = record.caption
         caption = None
         keywords = None
         detailed_caption = ""
-        old_keywords = metadata.get("MWG:Keywords", [])
-        file_path = metadata["SourceFile"]
         try:
             # Determine whether to generate caption, keywords, or both
-            if not self.config.no_caption and self.config.detailed_caption:
-                data = clean_json(self.llm_processor.describe_content(task="keywords", processed_image=processed_image))
-                detailed_caption = clean_string(self.llm_processor.describe_content(task="caption", processed_image=processed_image))               
+            if "caption" in responses:
+                data = clean_json(responses["keywords"])
+                detailed_caption = clean_string(responses["caption"])               
                 if existing_caption and self.config.update_caption:
                     caption = existing_caption + "<generated>" + detailed_caption + "</generated>"
                 else:
@@ -812,7 +2281,7 @@ class FileProcessor:
                     keywords = data.get("Keywords")
                    
             else:
-                data = clean_json(self.llm_processor.describe_content(task="caption_and_keywords", processed_image=processed_image))
+                data = clean_json(responses["caption_and_keywords"])
                          
                 if isinstance(data, dict):
                     keywords = data.get("Keywords")
@@ -825,26 +2294,23 @@ class FileProcessor:
                     else:
                         caption = existing_caption
                         
+            if keywords:
+                keywords = self.process_keywords(record, keywords)
             if not keywords:
-                status = "retry"
-                            
-            else:
-                status = "success"
-                keywords = self.process_keywords(metadata, keywords)
-
-            new_metadata["MWG:Description"] = caption
-            new_metadata["MWG:Keywords"] = keywords
-            new_metadata["XMP:Status"] = status
-            new_metadata["XMP:Identifier"] = metadata.get("XMP:Identifier", str(uuid.uuid4()))
-            new_metadata["SourceFile"] = file_path
-            return new_metadata
+                record.status = "retry"
+                return record
+                
+            record.caption = caption
+            record.keywords = keywords
+            record.status = "success"
+            if not record.identifier:
+                record.identifier = str(uuid.uuid4())
+            return record
             
         except Exception as e:
-            self.callback(f"Parse error for {file_path}: {str(e)}")
-            metadata["XMP:Status"] = "retry"
-            return metadata
+            return self._generation_failed(record, e)
             
-    def write_metadata(self, file_path, metadata):
+    def write_metadata(self, record):
         """Write metadata using persistent ExifTool instance"""
         if self.config.dry_run:
             print("Dry run. Not writing.")
@@ -855,56 +2321,85 @@ class FileProcessor:
                 params.append("-overwrite_original")
                 
             # Use existing ExifTool instance
-            self.et.set_tags(file_path, tags=metadata, params=params)
+            self.et.set_tags(record.path, tags=record.to_tags(), params=params)
+            if self.config.watch:
+                self.indexer.file_written(record.path)
             return True
             
+        except ExifToolGaveUp as e:
+            self._exiftool_gave_up(e)
+            return False
         except Exception as e:
-            self.callback(f"\nError writing metadata to {file_path}: {str(e)}")
-            print(f"\nError writing metadata to {file_path}: {str(e)}")
+            self.callback(f"\nError writing metadata to {record.path}: {str(e)}")
+            print(f"\nError writing metadata to {record.path}: {str(e)}")
             return False 
     
-    def process_keywords(self, metadata, new_keywords):
+    def process_keywords(self, record, new_keywords):
         """ Normalize extracted keywords and deduplicate them.
             If update is configured, combine the old and new keywords.
         """
         all_keywords = set()
               
         if self.config.update_keywords:
-            existing_keywords = metadata.get("MWG:Keywords", [])
-            if isinstance(existing_keywords, str):
-                existing_keywords = existing_keywords.split(",").strip()
-                
-            for keyword in existing_keywords:
+            for keyword in record.keywords:
                 normalized = normalize_keyword(keyword, self.banned_words)
                 if normalized:
-                    all_keywords.add(normalized)
+                    all_keywords.add(self.vocabulary.intern(normalized))
                            
         for keyword in new_keywords:
             normalized = normalize_keyword(keyword, self.banned_words)
             if normalized:
-                all_keywords.add(normalized)
+                all_keywords.add(self.vocabulary.intern(normalized))
    
         if all_keywords:        
-            return list(all_keywords)
+            return tuple(all_keywords)
         else:
             return None
         
-def main(config=None, callback=None, check_paused_or_stopped=None):
+def main(config=None, callback=None, check_paused_or_stopped=None, cancel_token=None):
     if config is None:
         config = Config.from_args()
+    if cancel_token is None:
+        cancel_token = CancellationToken()
+        
+    # First Ctrl-C finishes the files in flight, a second one aborts
+    if threading.current_thread() is threading.main_thread():
+        def interrupt(signum, frame):
+            print("Stopping after the files in progress. Press Ctrl-C again to abort.")
+            cancel_token.cancel()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+        previous_handler = signal.signal(signal.SIGINT, interrupt)
+    else:
+        previous_handler = None
              
+    # Started first so it sees the threads the processor starts
+    profiler = None
+    if config.profile:
+        profiler = RunProfiler(config.profile, config.profile_dir, config.profile_every, callback=callback)
+        profiler.start()
+        
     file_processor = FileProcessor(
-        config, check_paused_or_stopped, callback
+        config, check_paused_or_stopped, callback, cancel_token, profiler
     )      
     try:
-        file_processor.process_directory(config.directory)
+        if config.reparse_from_archive:
+            file_processor.reparse_archive()
+        else:
+            file_processor.process_directory(config.directory)
     except Exception as e:
         print(f"An error occurred during processing: {str(e)}")
         if callback:
             callback(f"Error: {str(e)}")
     finally:
         print("Waiting for indexer to complete...")
-        file_processor.indexer.join()
+        if file_processor.publisher is not None:
+            file_processor.publisher.join()
+        if file_processor.indexer is not None:
+            file_processor.indexer.join()
+        if previous_handler is not None:
+            signal.signal(signal.SIGINT, previous_handler)
+        if profiler is not None:
+            profiler.stop()
         print("Indexing completed.")
    
 if __name__ == "__main__":
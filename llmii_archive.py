@@ -0,0 +1,146 @@
+import glob
+import gzip
+import json
+import os
+import threading
+import time
+import uuid
+
+class ResponseArchive:
+    """ Append-only archive of the raw text the model returned for each
+        file, so keywords and captions can be worked out again when the
+        parsing or normalization changes, without generating anything.
+
+        Every run writes its own gzip compressed JSONL segments into the
+        archive directory, starting a new one every segment_bytes of
+        text. Each line holds the file's identifier and path, the raw
+        responses and the caption and keywords it had before. The answer
+        to a batched request gets a line of its own, and the lines of its
+        files only point into it. Segments are flushed after every
+        directory so a crash loses at most the directory in progress.
+    """
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        self.handle = None
+        self.written = 0
+        self.segment_number = 0
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_segment(self):
+        self.segment_number += 1
+        name = f"responses-{self.run_id}-{self.segment_number:04d}.jsonl.gz"
+        self.handle = gzip.open(os.path.join(self.directory, name), "wt", encoding="utf-8")
+        self.written = 0
+
+    def append(self, record, existing=None):
+        """ Archive the responses a FileRecord got from the model.
+            existing is the (keywords, caption) it had before.
+        """
+        if not record.responses or not record.identifier:
+            return
+        keywords, caption = existing or ((), None)
+        entry = {
+            "id": record.identifier,
+            "path": os.path.abspath(record.path),
+            "time": time.time(),
+            "existing": {"keywords": list(keywords), "caption": caption},
+        }
+        if record.batch is not None:
+            entry["batch"], entry["position"] = record.batch
+        else:
+            entry["responses"] = record.responses
+        self._write(json.dumps(entry) + "\n")
+
+    def append_batch(self, response, count):
+        """ Archive the raw answer to a batched request for count images.
+            Returns the id its files point to.
+        """
+        batch_id = uuid.uuid4().hex
+        self._write(json.dumps({
+            "batch": batch_id, "time": time.time(), "count": count, "response": response
+        }) + "\n")
+        return batch_id
+
+    def _write(self, line):
+        with self.lock:
+            if self.handle is None or self.written > self.segment_bytes:
+                if self.handle is not None:
+                    self.handle.close()
+                self._open_segment()
+            self.handle.write(line)
+            self.written += len(line)
+
+    def flush(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.flush()
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+
+    def segments(self):
+        """ Segment paths, oldest first
+        """
+        return sorted(glob.glob(os.path.join(self.directory, "responses-*.jsonl.gz")))
+
+    def _read_segment(self, path):
+        entries = []
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except (EOFError, OSError):
+
+            # The end of a segment that was being written during a crash
+            pass
+        return entries
+
+    def latest(self):
+        """ Yield the newest entry for every identifier. Segments are
+            read one at a time, newest first, so only one is ever in
+            memory along with the identifiers already seen. Entries from
+            a batch come with its raw answer as batch_response and the
+            number of images in it as batch_count.
+        """
+        seen = set()
+        
+        # Entries whose batch started in an older segment
+        waiting = []
+        for path in reversed(self.segments()):
+            entries = self._read_segment(path)
+            batches = {entry["batch"]: entry for entry in entries if "response" in entry}
+            still_waiting = []
+            for entry in waiting:
+                if entry["batch"] in batches:
+                    yield self._with_batch(entry, batches[entry["batch"]])
+                else:
+                    still_waiting.append(entry)
+            waiting = still_waiting
+            for entry in reversed(entries):
+                if "id" not in entry or entry["id"] in seen:
+                    continue
+                seen.add(entry["id"])
+                if "batch" not in entry:
+                    yield entry
+                elif entry["batch"] in batches:
+                    yield self._with_batch(entry, batches[entry["batch"]])
+                else:
+                    waiting.append(entry)
+                    
+        # Their batch was lost, so there is nothing to parse
+        yield from waiting
+
+    @staticmethod
+    def _with_batch(entry, batch):
+        entry["batch_response"] = batch["response"]
+        entry["batch_count"] = batch["count"]
+        return entry
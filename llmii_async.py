@@ -0,0 +1,188 @@
+import collections
+import json
+import threading
+import uuid
+
+class AsyncKoboldError(Exception):
+    pass
+
+class ImagePayload:
+    """ A base64 image already serialized as the JSON value of the
+        images field. It is built once per file and spliced into every
+        request for that file, so retries and follow up tasks don't
+        re-escape and copy a few hundred KB of base64 each time.
+    """
+    __slots__ = ("fragment",)
+    
+    def __init__(self, encoded):
+        if isinstance(encoded, str):
+            encoded = encoded.encode("ascii")
+            
+        # The base64 alphabet never needs escaping in a JSON string
+        self.fragment = b'["' + encoded + b'"]'
+        
+    def __len__(self):
+        return len(self.fragment)
+        
+    @classmethod
+    def combine(cls, payloads):
+        """ One payload carrying several images, in order
+        """
+        combined = cls.__new__(cls)
+        combined.fragment = b"[" + b",".join(p.fragment[1:-1] for p in payloads) + b"]"
+        return combined
+
+class AsyncKoboldClient:
+    """ Minimal asyncio client for the KoboldCpp generate API.
+
+        Every request goes through one aiohttp session, so connections
+        are kept alive and pooled instead of opened per generation.
+        Each generation gets its own genkey so that several can be in
+        flight at once and any one of them can be aborted.
+    """
+    def __init__(self, api_url, api_password=None, max_connections=8, **generation_params):
+        self.api_url = api_url.rstrip("/")
+        self.headers = {"Content-Type": "application/json"}
+        if api_password:
+            self.headers["Authorization"] = f"Bearer {api_password}"
+        self.max_connections = max_connections
+        self.generation_params = generation_params
+        self._session = None
+
+    def _get_session(self):
+        # aiohttp is slow to import, so only runs that talk to the
+        # server pay for it
+        import aiohttp
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+        return self._session
+
+    def new_genkey(self):
+        return f"KCPP{uuid.uuid4().hex[:8]}"
+
+    def _body(self, prompt, genkey, image=None, **kwargs):
+        """ Serialize a request. Only the small part of the body is
+            encoded here, the image is spliced in as bytes.
+        """
+        payload = {
+            "prompt": prompt,
+            "genkey": genkey,
+            **self.generation_params,
+            **kwargs,
+        }
+        body = json.dumps(payload).encode("utf-8")
+        if image is None:
+            return body
+        return b"".join((body[:-1], b', "images": ', image.fragment, b"}"))
+
+    async def generate(self, prompt, genkey=None, image=None, **kwargs):
+        """ Generate a full completion and return its text.
+        """
+        import aiohttp
+        body = self._body(prompt, genkey or self.new_genkey(), image, **kwargs)
+        session = self._get_session()
+        try:
+            async with session.post(f"{self.api_url}/api/v1/generate", data=body) as response:
+                response.raise_for_status()
+                result = await response.json()
+        except aiohttp.ClientError as e:
+            raise AsyncKoboldError(f"API request failed: {str(e)}")
+        if not result.get("results"):
+            raise AsyncKoboldError("API response missing results")
+        return result["results"][0]["text"]
+
+    async def stream(self, prompt, genkey=None, image=None, **kwargs):
+        """ Generate with server sent events, yielding tokens as they
+            arrive.
+        """
+        import aiohttp
+        body = self._body(prompt, genkey or self.new_genkey(), image, **kwargs)
+        session = self._get_session()
+        try:
+            async with session.post(f"{self.api_url}/api/extra/generate/stream", data=body) as response:
+                response.raise_for_status()
+                buffer = ""
+                async for chunk in response.content:
+                    buffer += chunk.decode("utf-8")
+                    while "\n\n" in buffer:
+                        message, buffer = buffer.split("\n\n", 1)
+                        for line in message.split("\n"):
+                            if not line.startswith("data: "):
+                                continue
+                            try:
+                                data = json.loads(line[6:])
+                            except json.JSONDecodeError:
+                                continue
+                            if data.get("token"):
+                                yield data["token"]
+                            if data.get("finish_reason") in ("length", "stop"):
+                                return
+        except aiohttp.ClientError as e:
+            raise AsyncKoboldError(f"API request failed: {str(e)}")
+
+    async def abort(self, genkey):
+        """ Ask the server to stop a generation. Returns True if it did.
+        """
+        import aiohttp
+        session = self._get_session()
+        try:
+            async with session.post(f"{self.api_url}/api/extra/abort", json={"genkey": genkey}) as response:
+                result = await response.json()
+                return result.get("success", False)
+        except (aiohttp.ClientError, json.JSONDecodeError):
+            return False
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+class LatencyTracker:
+    """ Recent generation times, for deciding when a request is slow
+        enough to be worth hedging.
+    """
+    def __init__(self, window=200, min_samples=20):
+        self.samples = collections.deque(maxlen=window)
+        self.min_samples = min_samples
+        
+    def add(self, seconds):
+        self.samples.append(seconds)
+        
+    def percentile(self, p):
+        """ The p-th percentile of recent times, or None until there
+            are enough of them to mean anything.
+        """
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+class AsyncEngine:
+    """ Runs an asyncio event loop in a background thread so the
+        synchronous parts of llmii can hand it coroutines and wait on
+        them, while many generations share the one loop.
+    """
+    def __init__(self):
+        
+        # asyncio is slow to import, so only runs that generate load it
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        """ Schedule a coroutine and return a concurrent.futures.Future
+        """
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """ Run a coroutine on the loop and block until it finishes
+        """
+        return self.submit(coro).result(timeout)
+
+    def close(self):
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.loop.close()
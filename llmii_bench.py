@@ -0,0 +1,287 @@
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from PIL import Image
+
+from llmii_async import AsyncKoboldClient, ImagePayload
+from llmii_image import FastImageProcessor, IMAGE_PROFILES
+from llmii import FileProcessor, FIELD_LOOKUP
+
+def list_images(directory, limit=None):
+    extensions = FastImageProcessor().image_extensions
+    extensions = [ext for exts in extensions.values() for ext in exts]
+    files = []
+    for root, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1].lower() in extensions:
+                files.append(os.path.join(root, filename))
+                if limit and len(files) >= limit:
+                    return files
+    return files
+
+def bench_profiles(args):
+    """ Run sample images through every image profile and report the
+        time to prepare each, the payload size and the vision tokens the
+        model will spend on it.
+    """
+    files = list_images(args.directory, args.limit)
+    if not files:
+        print(f"No images found in {args.directory}")
+        return
+    profiles = args.profile or list(IMAGE_PROFILES)
+
+    print(f"{len(files)} images")
+    print(f"{'profile':<18}{'ms/image':>10}{'KB/image':>10}{'tokens/image':>14}")
+    for name in profiles:
+        processor = FastImageProcessor.from_profile(name)
+        elapsed = 0
+        total_bytes = 0
+        total_tokens = 0
+        for file_path in files:
+            start = time.perf_counter()
+            encoded, _ = processor.process_image(file_path)
+            elapsed += time.perf_counter() - start
+            if not encoded:
+                continue
+            data = base64.b64decode(encoded)
+            with Image.open(io.BytesIO(data)) as img:
+                total_tokens += processor.estimate_tokens(*img.size)
+            total_bytes += len(encoded)
+        count = len(files)
+        print(
+            f"{name:<18}{elapsed / count * 1000:>10.1f}{total_bytes / count / 1024:>10.1f}"
+            f"{total_tokens / count:>14.0f}"
+        )
+
+def bench_payload(args):
+    """ Compare building generate request bodies by serializing the
+        whole payload each time against splicing in an ImagePayload
+        built once per image. Each image gets as many requests as a
+        detailed caption with one retry makes.
+    """
+    processor = FastImageProcessor.from_profile(args.image_profile)
+    files = list_images(args.directory, args.limit) if args.directory else []
+    if files:
+        images = [processor.process_image(f)[0] for f in files]
+    else:
+        # Random bytes make base64 about the size of a detailed JPEG
+        images = [base64.b64encode(os.urandom(args.size_kb * 768)).decode() for _ in range(20)]
+    client = AsyncKoboldClient("http://localhost:5001", max_length=150, temp=0.3)
+    prompt = "x" * 2000
+    
+    # Each method is (per image setup, per request step)
+    def serialize_setup(encoded):
+        return encoded
+        
+    def serialize_request(encoded):
+        payload = {"prompt": prompt, "genkey": "KCPP0000", **client.generation_params, "images": [encoded]}
+        return json.dumps(payload).encode("utf-8")
+        
+    def build_once_setup(encoded):
+        return ImagePayload(encoded)
+        
+    def build_once_request(image):
+        return client._body(prompt, "KCPP0000", image)
+        
+    methods = (
+        ("serialize each time", serialize_setup, serialize_request),
+        ("build once", build_once_setup, build_once_request),
+    )
+    print(f"{len(images)} images, {sum(map(len, images)) // len(images) // 1024} KB base64 each, {args.requests} requests per image")
+    print(f"{'method':<22}{'ms/image':>10}{'MB allocated/image':>20}")
+    for name, setup, request in methods:
+        start = time.perf_counter()
+        for encoded in images:
+            state = setup(encoded)
+            for _ in range(args.requests):
+                request(state)
+        elapsed = time.perf_counter() - start
+        
+        # Sum the peak of every step so temporaries are counted too
+        tracemalloc.start()
+        allocated = 0
+        for encoded in images:
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            state = setup(encoded)
+            allocated += tracemalloc.get_traced_memory()[1] - before
+            for _ in range(args.requests):
+                before = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                request(state)
+                allocated += tracemalloc.get_traced_memory()[1] - before
+            del state
+        tracemalloc.stop()
+        print(f"{name:<22}{elapsed / len(images) * 1000:>10.2f}{allocated / len(images) / 1024 / 1024:>20.2f}")
+
+def bench_fields(args):
+    """ Compare standardizing metadata by scanning the field lists for
+        every tag against the tag lookup table, on synthetic ExifTool
+        results. Also counts captions found, since the old caption list
+        ran two of its tags together.
+    """
+    keyword_fields = ["Keywords", "IPTC:Keywords", "Composite:keywords", "Subject", "DC:Subject", "XMP:Subject", "XMP-dc:Subject"]
+    caption_fields = [
+        "Description", "XMP:Description", "ImageDescription", "DC:Description", "EXIF:ImageDescription",
+        "Composite:Description", "Caption", "IPTC:Caption", "Composite:Caption" "IPTC:Caption-Abstract",
+        "XMP-dc:Description", "PNG:Description"
+    ]
+    identifier_fields = ["Identifier", "XMP:Identifier"]
+    status_fields = ["Status", "XMP:Status"]
+    
+    def list_scan(metadata):
+        keywords = []
+        status = identifier = caption = None
+        new_metadata = {"SourceFile": metadata.get("SourceFile")}
+        for key, value in metadata.items():
+            if key in keyword_fields:
+                keywords.extend(value)
+            if key in caption_fields:
+                caption = value
+            if key in identifier_fields:
+                identifier = value
+            if key in status_fields:
+                status = value
+        if keywords:
+            new_metadata["MWG:Keywords"] = keywords
+        if caption:
+            new_metadata["MWG:Description"] = caption
+        if status:
+            new_metadata["XMP:Status"] = status
+        if identifier:
+            new_metadata["XMP:Identifier"] = identifier
+        return new_metadata
+        
+    lookup = FileProcessor.__new__(FileProcessor)
+    lookup.field_lookup = FIELD_LOOKUP
+    
+    # A mix of what ExifTool hands back, with tags we don't read as well
+    rng = random.Random(0)
+    caption_tags = ["XMP:Description", "EXIF:ImageDescription", "IPTC:Caption-Abstract", "PNG:Description"]
+    other_tags = ["File:FileSize", "EXIF:Make", "EXIF:Model", "EXIF:ExposureTime", "EXIF:ISO", "Composite:ImageSize"]
+    samples = []
+    for i in range(args.count):
+        metadata = {"SourceFile": f"/photos/{i:06d}.jpg"}
+        for tag in other_tags:
+            metadata[tag] = "x"
+        if rng.random() < 0.8:
+            metadata["XMP:Subject"] = ["dog", "beach", "sunset"]
+        if rng.random() < 0.5:
+            metadata[rng.choice(caption_tags)] = "A dog on a beach at sunset."
+        if rng.random() < 0.7:
+            metadata["XMP:Identifier"] = str(i)
+            metadata["XMP:Status"] = "success"
+        samples.append(metadata)
+        
+    # Each method is (name, standardize, has_caption)
+    methods = (
+        ("list scan", list_scan, lambda r: "MWG:Description" in r),
+        ("lookup table", lookup.standardize_metadata, lambda r: r.caption is not None),
+    )
+    print(f"{len(samples)} metadata results")
+    print(f"{'method':<16}{'ms total':>10}{'captions found':>16}")
+    for name, standardize, has_caption in methods:
+        start = time.perf_counter()
+        results = [standardize(m) for m in samples]
+        elapsed = time.perf_counter() - start
+        captions = sum(1 for r in results if has_caption(r))
+        print(f"{name:<16}{elapsed * 1000:>10.1f}{captions:>16}")
+    print(f"{sum(1 for m in samples if any(t in m for t in caption_tags))} results carry a caption")
+
+def import_times(module):
+    """ Import a module in a fresh interpreter with -X importtime and
+        return {module: (self us, cumulative us)}
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+
+        # Nested imports are listed before the module importing them, so
+        # a new top level line ends everything the interpreter itself
+        # loaded at startup
+        if not name[1:].startswith(" ") and name.strip() != module:
+            times = {}
+            continue
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+def bench_startup(args):
+    """ Time how long each entry point takes to import in a fresh
+        interpreter, and show the imports that cost the most.
+    """
+    print(f"{'module':<20}{'ms median':>10}{'ms min':>10}")
+    slowest = {}
+    for module in args.module:
+        runs = []
+        for _ in range(args.runs):
+            try:
+                times = import_times(module)
+            except RuntimeError as e:
+                print(f"{module:<20}  could not be imported: {str(e)}")
+                break
+            runs.append(times)
+        if not runs:
+            continue
+        totals = [times[module][1] / 1000 for times in runs]
+        print(f"{module:<20}{statistics.median(totals):>10.1f}{min(totals):>10.1f}")
+        slowest[module] = sorted(
+            ((name, t[1]) for name, t in runs[-1].items() if name != module), key=lambda item: -item[1]
+        )[:args.top]
+
+    for module, imports in slowest.items():
+        print(f"\nSlowest imports under {module}")
+        for name, cumulative in imports:
+            print(f"{cumulative / 1000:>10.1f} ms  {name}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Image Indexer benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    profiles = commands.add_parser("profiles", help="Compare image profiles on sample images")
+    profiles.add_argument("directory", help="Directory of sample images")
+    profiles.add_argument("--profile", action="append", choices=list(IMAGE_PROFILES), help="Profile to include, can be repeated")
+    profiles.add_argument("--limit", type=int, default=50, help="Maximum number of images to use")
+    profiles.set_defaults(func=bench_profiles)
+    
+    payload = commands.add_parser("payload", help="Compare request body construction")
+    payload.add_argument("directory", nargs="?", help="Directory of sample images, random data if not given")
+    payload.add_argument("--image-profile", default="default", choices=list(IMAGE_PROFILES))
+    payload.add_argument("--limit", type=int, default=20, help="Maximum number of images to use")
+    payload.add_argument("--size-kb", type=int, default=300, help="Size of the random base64 images")
+    payload.add_argument("--requests", type=int, default=4, help="Requests per image")
+    payload.set_defaults(func=bench_payload)
+
+    fields = commands.add_parser("fields", help="Compare metadata field standardization")
+    fields.add_argument("--count", type=int, default=100000, help="Number of synthetic metadata results")
+    fields.set_defaults(func=bench_fields)
+
+    startup = commands.add_parser("startup", help="Time importing the entry points with -X importtime")
+    startup.add_argument("--module", action="append", default=None, help="Module to import, can be repeated")
+    startup.add_argument("--runs", type=int, default=5, help="Fresh interpreters per module")
+    startup.add_argument("--top", type=int, default=8, help="Number of slowest imports to show")
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    if args.command == "startup" and not args.module:
+        args.module = ["llmii", "llmii_renormalize", "llmii_search", "llmii_gui"]
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
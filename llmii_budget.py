@@ -0,0 +1,110 @@
+import sys
+import threading
+
+# Share of the budget each stage may hold. Every stage only ever waits
+# on its own share, so a full downstream stage can't deadlock the one
+# feeding it.
+STAGE_SHARES = {
+    "scan": 0.1,
+    "metadata": 0.3,
+    "images": 0.6,
+}
+
+def approx_size(obj):
+    """ Rough deep size in bytes of the strings, lists and dicts that
+        move through the pipeline. Close enough for accounting.
+    """
+    if isinstance(obj, (str, bytes)):
+        return sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(approx_size(item) for item in obj)
+    if hasattr(obj, "__slots__"):
+        return sys.getsizeof(obj) + sum(approx_size(getattr(obj, name, None)) for name in obj.__slots__)
+    if hasattr(obj, "__len__"):
+        return sys.getsizeof(obj) + len(obj)
+    return sys.getsizeof(obj)
+
+class MemoryBudget:
+    """ Byte budget shared by the scan, metadata and image stages.
+
+        A stage calls acquire before it holds more data and release
+        when it lets go. acquire blocks while the stage is over its
+        share, which backs the stages up towards the scanner instead of
+        letting data pile up. A single item bigger than the whole share
+        is still let through when the stage holds nothing, so that one
+        huge directory or image can't stall the run. With no limit the
+        budget only keeps count, for reporting.
+    """
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.used = {stage: 0 for stage in STAGE_SHARES}
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def limit(self, stage):
+        if not self.max_bytes:
+            return None
+        return int(self.max_bytes * STAGE_SHARES[stage])
+
+    def _full(self, stage, nbytes):
+        limit = self.limit(stage)
+        return limit is not None and self.used[stage] and self.used[stage] + nbytes > limit
+
+    def _take(self, stage, nbytes):
+        self.used[stage] += nbytes
+        self.peak = max(self.peak, self.total())
+
+    def acquire(self, stage, nbytes, should_stop=None):
+        """ Wait for room and take nbytes for a stage. Returns False
+            without taking anything if should_stop becomes true.
+        """
+        with self.condition:
+            while self._full(stage, nbytes):
+                if should_stop is not None and should_stop():
+                    return False
+                self.condition.wait(timeout=0.5)
+            self._take(stage, nbytes)
+            return True
+
+    def try_acquire(self, stage, nbytes):
+        """ Take nbytes for a stage only if there is room right now
+        """
+        with self.condition:
+            if self._full(stage, nbytes):
+                return False
+            self._take(stage, nbytes)
+            return True
+
+    async def acquire_async(self, stage, nbytes, should_stop=None, interval=0.05):
+        """ acquire for coroutines. The wait happens on the event loop,
+            so waiting coroutines never tie up the threads that the ones
+            holding the budget need to finish and release it.
+        """
+        import asyncio
+        while not self.try_acquire(stage, nbytes):
+            if should_stop is not None and should_stop():
+                return False
+            await asyncio.sleep(interval)
+        return True
+
+    def release(self, stage, nbytes):
+        with self.condition:
+            self.used[stage] = max(self.used[stage] - nbytes, 0)
+            self.condition.notify_all()
+
+    def total(self):
+        return sum(self.used.values())
+
+    def report(self):
+        """ One line summary of what each stage is holding
+        """
+        parts = []
+        for stage, used in self.used.items():
+            limit = self.limit(stage)
+            if limit:
+                parts.append(f"{stage} {used / 1048576:.1f}/{limit / 1048576:.1f} MB")
+            else:
+                parts.append(f"{stage} {used / 1048576:.1f} MB")
+        return "Buffers: " + ", ".join(parts) + f" (peak {self.peak / 1048576:.1f} MB)"
@@ -0,0 +1,60 @@
+import json
+import os
+import threading
+
+class CheckpointJournal:
+    """ Append-only journal of finished files and directories.
+
+        Every file that reaches a final result gets a line, and so does
+        every directory once all of its files are done. A resumed run
+        replays the journal and skips those without asking ExifTool
+        about them again. A line cut short by a crash is ignored.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed_files = set()
+        self.completed_directories = set()
+        self.lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            self._replay()
+
+        # A run that is not resuming starts a fresh journal
+        self.handle = open(path, "a" if resume else "w", encoding="utf-8")
+
+    def _replay(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if "file" in entry:
+                    self.completed_files.add(entry["file"])
+                elif "directory" in entry:
+                    self.completed_directories.add(entry["directory"])
+
+    def _append(self, entry):
+        with self.lock:
+            self.handle.write(json.dumps(entry) + "\n")
+            self.handle.flush()
+
+    def file_done(self, file_path, status):
+        file_path = os.path.abspath(file_path)
+        self.completed_files.add(file_path)
+        self._append({"file": file_path, "status": status})
+
+    def directory_done(self, directory):
+        directory = os.path.abspath(directory)
+        self.completed_directories.add(directory)
+        self._append({"directory": directory})
+
+    def is_file_done(self, file_path):
+        return os.path.abspath(file_path) in self.completed_files
+
+    def is_directory_done(self, directory):
+        return os.path.abspath(directory) in self.completed_directories
+
+    def close(self):
+        with self.lock:
+            self.handle.close()
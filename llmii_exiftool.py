@@ -0,0 +1,215 @@
+import os
+import threading
+import time
+
+class ExifToolFailure(Exception):
+    """ ExifTool died or stopped answering during a call
+    """
+
+class ExifToolGaveUp(Exception):
+    """ ExifTool hung or died too many times to keep starting it again
+    """
+
+class ExifToolSupervisor:
+    """ Stands in for ExifToolHelper and keeps one ExifTool process
+        healthy for the whole run.
+
+        Every call has to finish within timeout seconds, plus per_file
+        seconds for each file in it. A process found dead is started
+        again before the next call. One that hangs is killed and started
+        again, and the call fails with ExifToolFailure.
+
+        A batch read that fails is read again one file at a time, so only
+        the file that broke it is skipped. Single file calls are not
+        retried, since that file is the likely cause.
+
+        A call that is given up on leaves its thread blocked for good,
+        holding the pipes of the killed process. After max_hangs of them
+        every further call raises ExifToolGaveUp instead of starting
+        ExifTool yet again.
+
+        Killing a hung process relies on the _process and
+        _flag_running_false internals of pyexiftool 0.5. Without them
+        the old helper is only asked to stop, a hung process is left
+        running, and a thread stuck on one that crashed keeps polling
+        its closed pipe.
+    """
+    def __init__(self, timeout=30, per_file=0.5, callback=None, max_hangs=10, **kwargs):
+        self.timeout = timeout
+        self.per_file = per_file
+        self.callback = callback or print
+        self.max_hangs = max_hangs
+        self.kwargs = kwargs
+        self.lock = threading.Lock()
+        self.stats = {"restarts": 0, "timeouts": 0, "skipped": 0}
+        self.skipped = []
+
+        # Pipe that never delivers anything and the processes parked on
+        # it, or the helpers left behind, see _abandon
+        self._parked = None
+        self._abandoned = []
+        self.helper = None
+        self.managed = None
+        self._start()
+
+    def _start(self):
+        import exiftool
+        self.helper = exiftool.ExifToolHelper(**self.kwargs)
+        
+        # Started now, so a helper that isn't running is one that died
+        if not getattr(self.helper, "running", True):
+            self.helper.run()
+        if self.managed is None:
+            self.managed = hasattr(self.helper, "_process") and hasattr(self.helper, "_flag_running_false")
+            if not self.managed:
+                self.callback("This version of pyexiftool doesn't let a hung ExifTool be killed, it will be left running")
+
+    def _alive(self):
+        
+        # Asking the helper if it is running drops a dead process, which
+        # _abandon still needs
+        if self.managed:
+            process = self.helper._process
+            if process is not None:
+                return process.poll() is None
+        return getattr(self.helper, "running", True)
+
+    def _restart(self, reason):
+        self.stats["restarts"] += 1
+        self.callback(f"Restarting ExifTool: {reason}")
+        if self.managed:
+            process = self.helper._process
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+
+            # The old process is gone, so stop the helper from talking to it
+            self.helper._flag_running_false()
+        else:
+            
+            # Stopping waits for an answer a hung process never gives
+            stopper = threading.Thread(target=self._stop_quietly, args=(self.helper,), daemon=True)
+            stopper.start()
+            stopper.join(2)
+        self._start()
+
+    @staticmethod
+    def _stop_quietly(helper):
+        try:
+            helper.terminate()
+        except Exception:
+            pass
+
+    def _abandon(self):
+        """ Give up on a call stuck reading from ExifTool. The read can't
+            be interrupted, and once the pipe hits end of file pyexiftool
+            keeps polling it forever. Its output pipes are swapped for one
+            that never delivers anything before the process is killed, so
+            the stuck thread just waits instead. The process is kept so
+            those descriptors are never closed and handed to a new one.
+        """
+        if not self.managed:
+            
+            # Keeping the helper at least keeps its pipes from being
+            # handed to the next process
+            self._abandoned.append(self.helper)
+            return
+        process = self.helper._process
+        if process is None:
+            return
+        if self._parked is None:
+            self._parked = os.pipe()
+        for stream in (process.stdout, process.stderr):
+            os.dup2(self._parked[0], stream.fileno())
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        self._abandoned.append(process)
+
+    def _call(self, files, method, *args, **kwargs):
+        """ Run one helper method with the time limit. files is how many
+            files the call covers.
+        """
+        with self.lock:
+            if len(self._abandoned) >= self.max_hangs:
+                raise ExifToolGaveUp(f"ExifTool hung or died during {len(self._abandoned)} calls, not starting it again")
+            if not self._alive():
+                self._restart("the process had stopped")
+            result = {}
+
+            def run():
+                try:
+                    result["value"] = getattr(self.helper, method)(*args, **kwargs)
+                except Exception as e:
+                    result["error"] = e
+            worker = threading.Thread(target=run, daemon=True)
+            worker.start()
+            
+            # Checking on the process while waiting catches a crash
+            # without waiting out the whole time limit
+            timeout = self.timeout + self.per_file * files
+            deadline = time.monotonic() + timeout
+            while worker.is_alive() and time.monotonic() < deadline:
+                worker.join(0.2)
+                if worker.is_alive() and not self._alive():
+                    break
+
+            if worker.is_alive():
+                died = not self._alive()
+                if not died:
+                    self.stats["timeouts"] += 1
+                self._abandon()
+                self._restart("the process died" if died else f"no answer after {timeout:.0f}s")
+                raise ExifToolFailure("ExifTool died" if died else f"ExifTool timed out after {timeout:.0f}s")
+            if "error" in result:
+                if not self._alive():
+                    self._restart("the process died")
+                    raise ExifToolFailure(f"ExifTool died: {str(result['error'])}")
+                raise result["error"]
+            return result["value"]
+
+    def _skip(self, file_path, error):
+        self.stats["skipped"] += 1
+        self.skipped.append(file_path)
+        self.callback(f"Skipping {file_path}, ExifTool failed on it: {str(error)}")
+
+    def get_tags(self, files, tags=None, params=None):
+        if isinstance(files, (str, bytes, os.PathLike)):
+            return self._call(1, "get_tags", files, tags=tags, params=params)
+        files = list(files)
+        try:
+            return self._call(len(files), "get_tags", files, tags=tags, params=params)
+        except ExifToolFailure:
+            if len(files) == 1:
+                self._skip(files[0], "no usable answer")
+                return []
+
+        # Read one at a time so the file that broke the batch is the only
+        # one lost
+        results = []
+        for file_path in files:
+            try:
+                results.extend(self._call(1, "get_tags", file_path, tags=tags, params=params))
+            except ExifToolFailure as e:
+                self._skip(file_path, e)
+        return results
+
+    def set_tags(self, files, tags, params=None):
+        count = 1 if isinstance(files, (str, bytes, os.PathLike)) else len(files)
+        return self._call(count, "set_tags", files, tags=tags, params=params)
+
+    def execute(self, *params, raw_bytes=False):
+        
+        # Commands chained with -execute each count as a file
+        return self._call(1 + params.count("-execute"), "execute", *params, raw_bytes=raw_bytes)
+
+    def report(self):
+        return (
+            f"ExifTool restarts: {self.stats['restarts']}, timeouts: {self.stats['timeouts']}, "
+            f"files skipped: {self.stats['skipped']}"
+        )
+
+    def terminate(self):
+        with self.lock:
+            if self._alive():
+                self.helper.terminate()
@@ -2,8 +2,7 @@ import sys
 import os
 import json
 import shutil
-import llmii
-from koboldapi import KoboldAPI
+from llmii_profiles import IMAGE_PROFILES
 from PyQt6.QtCore import QThread, pyqtSignal, QObject, Qt
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, 
                            QLabel, QLineEdit, QCheckBox, QPushButton, QFileDialog, 
@@ -72,6 +71,13 @@ class SettingsDialog(QDialog):
         gen_count_layout.addWidget(self.gen_count)
         layout.addLayout(gen_count_layout)
         
+        image_profile_layout = QHBoxLayout()
+        self.image_profile_combo = QComboBox()
+        self.image_profile_combo.addItems(list(IMAGE_PROFILES))
+        image_profile_layout.addWidget(QLabel("Image Profile: "))
+        image_profile_layout.addWidget(self.image_profile_combo)
+        layout.addLayout(image_profile_layout)
+        
         options_group = QGroupBox("File Options")
         options_layout = QVBoxLayout()
         
@@ -83,6 +89,7 @@ class SettingsDialog(QDialog):
         self.dry_run_checkbox = QCheckBox("Pretend mode / Dry run")
         self.skip_verify_checkbox = QCheckBox("No file checking (not recommended)")
         self.quick_fail_checkbox = QCheckBox("Quick fail (recommended for newer models)")
+        self.stream_checkbox = QCheckBox("Stop generating as soon as keywords arrive (streaming)")
         
         options_layout.addWidget(self.no_crawl_checkbox)
         options_layout.addWidget(self.reprocess_all_checkbox)
@@ -92,6 +99,7 @@ class SettingsDialog(QDialog):
         options_layout.addWidget(self.dry_run_checkbox)
         options_layout.addWidget(self.skip_verify_checkbox)
         options_layout.addWidget(self.quick_fail_checkbox)
+        options_layout.addWidget(self.stream_checkbox)
         
         options_group.setLayout(options_layout)
         layout.addWidget(options_group)
@@ -130,6 +138,7 @@ class SettingsDialog(QDialog):
                 self.api_password_input.setText(settings.get('api_password', ''))
                 self.system_instruction_input.setText(settings.get('system_instruction', 'You are a helpful assistant.'))
                 self.gen_count.setValue(settings.get('gen_count', 150))
+                self.image_profile_combo.setCurrentText(settings.get('image_profile', 'default'))
                 
                 self.no_crawl_checkbox.setChecked(settings.get('no_crawl', False))
                 self.reprocess_failed_checkbox.setChecked(settings.get('reprocess_failed', False))
@@ -139,6 +148,7 @@ class SettingsDialog(QDialog):
                 self.dry_run_checkbox.setChecked(settings.get('dry_run', False))
                 self.skip_verify_checkbox.setChecked(settings.get('skip_verify', False))
                 self.quick_fail_checkbox.setChecked(settings.get('quick_fail', False))
+                self.stream_checkbox.setChecked(settings.get('stream', False))
                 self.caption_instruction_input.setText(settings.get('caption_instruction', 'Describe the image in detail. Be specific.'))
                 
                 # Set radio button based on settings
@@ -162,6 +172,7 @@ class SettingsDialog(QDialog):
             'api_password': self.api_password_input.text(),
             'system_instruction': self.system_instruction_input.text(),
             'gen_count': self.gen_count.value(),
+            'image_profile': self.image_profile_combo.currentText(),
             'no_crawl': self.no_crawl_checkbox.isChecked(),
             'reprocess_failed': self.reprocess_failed_checkbox.isChecked(),
             'reprocess_all': self.reprocess_all_checkbox.isChecked(),
@@ -170,6 +181,7 @@ class SettingsDialog(QDialog):
             'dry_run': self.dry_run_checkbox.isChecked(),
             'skip_verify': self.skip_verify_checkbox.isChecked(),
             'quick_fail': self.quick_fail_checkbox.isChecked(),
+            'stream': self.stream_checkbox.isChecked(),
             'update_keywords': self.update_keywords_checkbox.isChecked(),
             'caption_instruction': self.caption_instruction_input.text(),
             'detailed_caption': self.detailed_caption_radio.isChecked(),
@@ -193,6 +205,7 @@ class APICheckThread(QThread):
         self.running = True
         
     def run(self):
+        from koboldapi import KoboldAPI
         while self.running:
             try:
                 api = KoboldAPI(self.api_url)
@@ -214,24 +227,28 @@ class IndexerThread(QThread):
     def __init__(self, config):
         super().__init__()
         self.config = config
-        self.paused = False
-        self.stopped = False
+        
+        # The indexer is imported once there is something to run, so the
+        # window comes up without waiting for it
+        import llmii
+        self.cancel_token = llmii.CancellationToken()
 
     def run(self):
+        import llmii
         try:
-            llmii.main(self.config, self.output_received.emit, self.check_paused_or_stopped)
+            llmii.main(self.config, self.output_received.emit, cancel_token=self.cancel_token)
         except Exception as e:
             self.output_received.emit(f"Error: {str(e)}")
 
-    def check_paused_or_stopped(self):
-        if self.stopped:
-            raise Exception("Indexer stopped by user")
-        if self.paused:
-            while self.paused and not self.stopped:
-                self.msleep(100)
-            if self.stopped:
-                raise Exception("Indexer stopped by user")
-        return self.paused
+    def set_paused(self, paused):
+        if paused:
+            self.cancel_token.pause()
+        else:
+            self.cancel_token.resume()
+
+    def stop(self):
+        # Files in progress are finished and written before the thread ends
+        self.cancel_token.cancel()
 
 class PauseHandler(QObject):
     pause_signal = pyqtSignal(bool)
@@ -414,6 +431,7 @@ Limit response to things clearly and obviously apparent; do not guess. Do not co
                               "Please wait for the API to be available before running the indexer.")
             return
             
+        import llmii
         config = llmii.Config()
         
         # Get directory from main window
@@ -431,6 +449,7 @@ Limit response to things clearly and obviously apparent; do not guess. Do not co
         config.dry_run = self.settings_dialog.dry_run_checkbox.isChecked()
         config.skip_verify = self.settings_dialog.skip_verify_checkbox.isChecked()
         config.quick_fail = self.settings_dialog.quick_fail_checkbox.isChecked()
+        config.stream = self.settings_dialog.stream_checkbox.isChecked()
         
         # Load caption settings
         config.detailed_caption = self.settings_dialog.detailed_caption_radio.isChecked()
@@ -447,6 +466,7 @@ Limit response to things clearly and obviously apparent; do not guess. Do not co
         config.update_caption = self.settings_dialog.update_caption_checkbox.isChecked()
         #config.overwrite_caption = self.settings_dialog.overwrite_caption_checkbox.isChecked()            
         config.gen_count = self.settings_dialog.gen_count.value()
+        config.image_profile = self.settings_dialog.image_profile_combo.currentText()
              
         self.indexer_thread = IndexerThread(config)
         self.indexer_thread.output_received.connect(self.update_output)
@@ -463,11 +483,11 @@ Limit response to things clearly and obviously apparent; do not guess. Do not co
 
     def set_paused(self, paused):
         if self.indexer_thread:
-            self.indexer_thread.paused = paused
+            self.indexer_thread.set_paused(paused)
 
     def set_stopped(self):
         if self.indexer_thread:
-            self.indexer_thread.stopped = True
+            self.indexer_thread.stop()
 
     def toggle_pause(self):
         if self.pause_button.text() == "Pause":
@@ -481,8 +501,9 @@ Limit response to things clearly and obviously apparent; do not guess. Do not co
 
     def stop_indexer(self):
         self.pause_handler.stop_signal.emit()
-        self.update_output("Stopping indexer...")
-        self.run_button.setEnabled(True)
+        self.update_output("Stopping indexer after the files in progress...")
+        
+        # Run is re-enabled by indexer_finished once the thread has drained
         self.pause_button.setEnabled(False)
         self.stop_button.setEnabled(False)
 
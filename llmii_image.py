@@ -0,0 +1,201 @@
+import base64
+import io
+import math
+import os
+import re
+
+from PIL import Image
+from koboldapi import ImageProcessor, KoboldAPIError
+
+from llmii_profiles import IMAGE_PROFILES
+
+# Embedded previews found in RAW files, in the order we prefer them
+RAW_PREVIEW_TAGS = ["PreviewImage", "JpgFromRaw", "OtherImage", "ThumbnailImage"]
+
+# PIL transpose for each EXIF orientation value
+ORIENTATION_TRANSPOSE = {
+    2: [Image.Transpose.FLIP_LEFT_RIGHT],
+    3: [Image.Transpose.ROTATE_180],
+    4: [Image.Transpose.FLIP_TOP_BOTTOM],
+    5: [Image.Transpose.FLIP_LEFT_RIGHT, Image.Transpose.ROTATE_90],
+    6: [Image.Transpose.ROTATE_270],
+    7: [Image.Transpose.FLIP_LEFT_RIGHT, Image.Transpose.ROTATE_270],
+    8: [Image.Transpose.ROTATE_90],
+}
+
+class FastImageProcessor(ImageProcessor):
+    """ ImageProcessor that avoids decoding more pixels than the model
+        will ever see.
+
+        RAW files almost always carry a full size or large JPEG preview.
+        ExifTool pulls it out without touching the sensor data, and
+        only when no preview is big enough is the RAW demosaiced.
+        
+        JPEGs, previews included, are decoded in draft mode. The decoder
+        scales by 1/2, 1/4 or 1/8 while decoding the DCT blocks, so a
+        45 MP photo never exists in memory at full size.
+    """
+    def __init__(self, max_dimension=560, et=None, aspect="stretch", image_format="JPEG",
+                 quality=95, max_bytes=None, token_patch=28, fixed_tokens=None, **kwargs):
+        super().__init__(max_dimension=max_dimension, **kwargs)
+        self.et = et
+        self.aspect = aspect
+        self.image_format = image_format
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.token_patch = token_patch
+        self.fixed_tokens = fixed_tokens
+
+    @classmethod
+    def from_profile(cls, name, et=None):
+        if name not in IMAGE_PROFILES:
+            raise ValueError(f"Unknown image profile: {name}")
+        return cls(et=et, **IMAGE_PROFILES[name])
+
+    def estimate_tokens(self, width, height):
+        """ Vision tokens the model will spend on an image of this size
+        """
+        if self.fixed_tokens:
+            return self.fixed_tokens
+        return math.ceil(width / self.token_patch) * math.ceil(height / self.token_patch)
+
+    def _scaled_size(self, width, height):
+        """ Size after scaling to max_dimension, before any padding or
+            cropping to the tile size.
+        """
+        if self.aspect == "stretch":
+            return self._calculate_dimensions(width, height)
+        scale = min(self.max_dimension / width, self.max_dimension / height)
+        return max(round(width * scale), 1), max(round(height * scale), 1)
+
+    def _resize_image(self, img):
+        """ Resize to the profile's size and make both sides a multiple
+            of the tile size the way the profile asks for.
+        """
+        if self.aspect == "stretch":
+            return super()._resize_image(img)
+        width, height = self._scaled_size(*img.size)
+        if (width, height) != img.size:
+            img = img.resize((width, height), Image.Resampling.BICUBIC)
+        if self.aspect == "crop":
+            new_width = max(width // self.lcm, 1) * self.lcm
+            new_height = max(height // self.lcm, 1) * self.lcm
+            if new_width > width or new_height > height:
+                img = img.resize((max(new_width, width), max(new_height, height)), Image.Resampling.BICUBIC)
+                width, height = img.size
+            left = (width - new_width) // 2
+            top = (height - new_height) // 2
+            return img.crop((left, top, left + new_width, top + new_height))
+        new_width = math.ceil(width / self.lcm) * self.lcm
+        new_height = math.ceil(height / self.lcm) * self.lcm
+        if (new_width, new_height) == (width, height):
+            return img
+        canvas = Image.new("RGB", (new_width, new_height))
+        canvas.paste(img, ((new_width - width) // 2, (new_height - height) // 2))
+        return canvas
+
+    def _save(self, img):
+        """ Encode in the profile's format, lowering the quality until
+            it fits in max_bytes if there is a limit.
+        """
+        quality = self.quality
+        while True:
+            with io.BytesIO() as buffer:
+                img.save(buffer, format=self.image_format, quality=quality)
+                data = buffer.getvalue()
+            if not self.max_bytes or len(data) <= self.max_bytes or quality <= 40:
+                return data
+            quality -= 10
+
+    def _encode(self, img, orientation=None):
+        """ Decode, orient, resize and base64 encode an opened image
+        """
+        if img.format == "JPEG":
+        
+            # Picks the smallest scale that is still at least the target size
+            img.draft("RGB", self._scaled_size(*img.size))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        for transpose in ORIENTATION_TRANSPOSE.get(orientation, []):
+            img = img.transpose(transpose)
+        resized = self._resize_image(img)
+        return base64.b64encode(self._save(resized)).decode()
+
+    def _preview_candidates(self, file_path):
+        """ Return (orientation, [(size_in_bytes, tag)]) for the previews
+            embedded in a file, smallest first.
+        """
+        results = self.et.get_tags(file_path, tags=RAW_PREVIEW_TAGS + ["Orientation"], params=["-n"])
+        if not results:
+            return None, []
+        candidates = []
+        orientation = None
+        for key, value in results[0].items():
+            tag = key.split(":")[-1]
+            if tag == "Orientation":
+                orientation = value
+                continue
+            if tag not in RAW_PREVIEW_TAGS:
+                continue
+
+            # Binary tags are reported as "(Binary data 123456 bytes, use -b option to extract)"
+            match = re.search(r"(\d+) bytes", str(value))
+            if match:
+                candidates.append((int(match.group(1)), key))
+        candidates.sort()
+        return orientation, candidates
+
+    def extract_raw_preview(self, file_path):
+        """ Return (image, orientation) for the smallest embedded
+            preview that is at least max_dimension on its long side, or
+            None. Smallest is enough since it will be shrunk anyway, and
+            decodes fastest. The image is opened but not yet decoded.
+        """
+        if self.et is None:
+            return None
+        orientation, candidates = self._preview_candidates(file_path)
+        for size, tag in candidates:
+            data = self.et.execute("-b", f"-{tag}", str(file_path), raw_bytes=True)
+            if not data:
+                continue
+            try:
+                img = Image.open(io.BytesIO(data))
+            except (IOError, OSError):
+                continue
+
+            # Opening only reads the header so this check is cheap
+            if max(img.size) < self.max_dimension:
+                continue
+            return img, orientation
+        return None
+
+    def process_raw_image(self, file_path):
+        """ Process RAW image files from an embedded preview if there
+            is a big enough one, otherwise decode the RAW.
+        """
+        try:
+            preview = self.extract_raw_preview(file_path)
+        except Exception:
+            preview = None
+        if preview is not None:
+            return self._encode(*preview)
+        return super().process_raw_image(file_path)
+        
+    def route_image(self, file_path):
+        """ Process image """
+        if os.path.getsize(file_path) > self.max_file_size:
+            raise ValueError(f"File exceeds size limit of {self.max_file_size} bytes")
+            
+        image_type = self._get_image_type(file_path)
+        if image_type is None:
+            return None
+        if image_type == "RAW":
+            return self.process_raw_image(file_path)
+            
+        try:
+            with Image.open(file_path) as img:
+                if img.width <= 0 or img.height <= 0:
+                    raise ValueError("Invalid image dimensions")
+                return self._encode(img)
+        except (IOError, OSError) as e:
+            raise KoboldAPIError(f"Image processing failed: {str(e)}")
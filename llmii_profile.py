@@ -0,0 +1,281 @@
+import collections
+import io
+import os
+import sys
+import threading
+import time
+
+PROFILE_MODES = ("cpu", "mem", "sample")
+
+# Pipeline stage of each function that starts one. Time or memory is
+# put down to the innermost of these on the stack, so a write made
+# while checking a file counts as writing.
+STAGE_FUNCTIONS = {
+    "_scan": "scan",
+    "_index_directory": "scan",
+    "_get_metadata_batch": "read metadata",
+    "_validate_batch": "read metadata",
+    "process_image": "prepare image",
+    "generate_metadata": "generate",
+    "generate_metadata_async": "generate",
+    "describe_batch": "generate",
+    "recover_async": "generate",
+    "parse_generation": "parse",
+    "_try_reparse": "parse",
+    "write_metadata": "write metadata",
+}
+
+# Where an idle thread sits while it waits for work or a response
+WAITING_FILES = ("threading.py", "selectors.py", "queue.py", "thread.py")
+
+def frame_stage(frame):
+    """ The stage a stack belongs to, looking from the innermost frame
+        out. Stacks outside every stage that are blocked count as
+        waiting.
+    """
+    innermost = frame
+    while frame is not None:
+        stage = STAGE_FUNCTIONS.get(frame.f_code.co_name)
+        if stage:
+            return stage
+        frame = frame.f_back
+    if os.path.basename(innermost.f_code.co_filename) in WAITING_FILES:
+        return "waiting"
+    return "other"
+
+def stage_lines():
+    """ filename -> [(first line, last line, stage)] for the stage
+        functions, since tracemalloc frames only carry a line number
+    """
+    import dis
+    import inspect
+    import llmii
+    import llmii_image
+    ranges = collections.defaultdict(list)
+    seen = set()
+    for module in (llmii, llmii_image):
+        for _, cls in inspect.getmembers(module, inspect.isclass):
+            for name, function in inspect.getmembers(cls, inspect.isfunction):
+                if name not in STAGE_FUNCTIONS or function.__code__ in seen:
+                    continue
+                code = function.__code__
+                seen.add(code)
+                lines = [line for _, line in dis.findlinestarts(code) if line]
+                ranges[code.co_filename].append((code.co_firstlineno, max(lines or [0]), STAGE_FUNCTIONS[name]))
+    return ranges
+
+def _line_stage(ranges, filename, lineno):
+    for first, last, stage in ranges.get(filename, ()):
+        if first <= lineno <= last:
+            return stage
+    return None
+
+class RunProfiler:
+    """ Optional profiling of a whole run for --profile.
+
+        cpu runs cProfile in every thread and writes the pstats data and
+        a report with the slowest functions. mem takes a tracemalloc
+        snapshot every N files and reports what grew since the last one.
+        sample looks at every thread's stack every few milliseconds,
+        which is cheap enough to leave on for a long run.
+
+        Each report also adds up the time or memory per pipeline stage.
+    """
+    def __init__(self, mode, directory=".", every=100, interval=0.01, callback=None):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.directory = directory
+        self.every = every
+        self.interval = interval
+        self.callback = callback or print
+        self.lock = threading.Lock()
+        self.files_done = 0
+        self.started = None
+        self.base = os.path.join(directory, f"llmii-profile-{time.strftime('%Y%m%d-%H%M%S')}-{mode}")
+
+        # cpu
+        self.profiles = []
+
+        # mem
+        self.previous = None
+        self.ranges = None
+
+        # sample
+        self.samples = collections.Counter()
+        self.functions = collections.Counter()
+        self.sample_count = 0
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.started = time.time()
+        if self.mode == "cpu":
+            self._start_cpu()
+        elif self.mode == "mem":
+            import tracemalloc
+
+            # Tracing imports is very slow and their memory isn't what
+            # we're after, so load what the run imports lazily first
+            import aiohttp, exiftool, json_repair, koboldapi
+            self.ranges = stage_lines()
+            tracemalloc.start(10)
+        else:
+            self.sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        """ Stop profiling and write the report. Returns its path.
+        """
+        if self.mode == "cpu":
+            path = self._stop_cpu()
+        elif self.mode == "mem":
+            import tracemalloc
+            self._snapshot()
+            tracemalloc.stop()
+            path = self.base + ".txt"
+        else:
+            self.stopped.set()
+            self.sampler.join()
+            path = self._write_samples()
+        self.callback(f"Profile written to {path}")
+        return path
+
+    def file_done(self):
+        """ Called for every finished file, for the memory snapshots
+        """
+        if self.mode != "mem":
+            return
+        with self.lock:
+            self.files_done += 1
+            take = self.files_done % self.every == 0
+        if take:
+            self._snapshot()
+
+    # cpu
+
+    def _start_cpu(self):
+        import cProfile
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+
+        # Threads started from here on get their own profiler. Newer
+        # Pythons only allow one, which then sees every thread anyway
+        def thread_start(*args):
+            sys.setprofile(None)
+            thread_profile = cProfile.Profile()
+            try:
+                thread_profile.enable()
+            except ValueError:
+                return
+            with self.lock:
+                self.profiles.append(thread_profile)
+        threading.setprofile(thread_start)
+        profile.enable()
+
+    def _stop_cpu(self):
+        import pstats
+        threading.setprofile(None)
+        self.profiles[0].disable()
+        stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(self.base + ".pstats")
+
+        stages = collections.defaultdict(float)
+        for (filename, line, name), (_, calls, own, cumulative, _) in stats.stats.items():
+            if name in STAGE_FUNCTIONS:
+                stages[STAGE_FUNCTIONS[name]] += cumulative
+
+        report = io.StringIO()
+        report.write(f"CPU profile of {time.time() - self.started:.1f}s, all threads\n\n")
+        report.write("Cumulative seconds per stage. A stage called from inside another\n")
+        report.write("is counted in both, and threads waiting on the model add up.\n")
+        for stage, seconds in sorted(stages.items(), key=lambda item: -item[1]):
+            report.write(f"{seconds:>12.2f}  {stage}\n")
+        report.write("\n")
+        stats.stream = report
+        stats.sort_stats("cumulative").print_stats(40)
+        stats.sort_stats("tottime").print_stats(40)
+        path = self.base + ".txt"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(report.getvalue())
+        return path
+
+    # mem
+
+    def _snapshot(self):
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+
+        stages = collections.Counter()
+        for stat in snapshot.statistics("traceback"):
+            stage = "other"
+            for frame in reversed(stat.traceback):
+                found = _line_stage(self.ranges, frame.filename, frame.lineno)
+                if found:
+                    stage = found
+                    break
+            stages[stage] += stat.size
+
+        lines = [f"== After {self.files_done} files, {time.time() - self.started:.1f}s =="]
+        current, peak = tracemalloc.get_traced_memory()
+        lines.append(f"Traced {current / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB")
+        lines.append("MB held per stage:")
+        for stage, size in stages.most_common():
+            lines.append(f"{size / 1024 / 1024:>10.2f}  {stage}")
+        lines.append("Largest allocations by line:")
+        for stat in snapshot.statistics("lineno")[:15]:
+            lines.append(f"    {stat}")
+        if self.previous is not None:
+            lines.append("Growth since the last snapshot:")
+            for stat in snapshot.compare_to(self.previous, "lineno")[:15]:
+                lines.append(f"    {stat}")
+        self.previous = snapshot
+        with self.lock:
+            with open(self.base + ".txt", "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n\n")
+
+    # sample
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident, str(ident))
+                self.samples[(name, frame_stage(frame))] += 1
+                code = frame.f_code
+                self.functions[f"{os.path.basename(code.co_filename)}:{code.co_firstlineno} {code.co_name}"] += 1
+            self.sample_count += 1
+
+    def _write_samples(self):
+        lines = [
+            f"Sampled every {self.interval * 1000:.0f} ms for {time.time() - self.started:.1f}s, {self.sample_count} samples",
+            "",
+            "Thread seconds and share of all thread samples per stage:",
+        ]
+        stages = collections.Counter()
+        for (_, stage), count in self.samples.items():
+            stages[stage] += count
+        thread_samples = sum(stages.values()) or 1
+        for stage, count in stages.most_common():
+            lines.append(f"{count * self.interval:>10.1f}s {count / thread_samples:>7.1%}  {stage}")
+            
+        # Per thread the share is of the whole run
+        lines.extend(["", "Share of the run per thread:"])
+        total = self.sample_count or 1
+        for (thread, stage), count in sorted(self.samples.items(), key=lambda item: (item[0][0], -item[1])):
+            lines.append(f"{count / total:>8.1%}  {thread:<24} {stage}")
+        lines.extend(["", "Innermost functions, share of all thread samples:"])
+        for function, count in self.functions.most_common(30):
+            lines.append(f"{count / thread_samples:>8.1%}  {function}")
+        path = self.base + ".txt"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
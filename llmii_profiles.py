@@ -0,0 +1,38 @@
+# Resize and encoding settings per model family. token_patch is the
+# number of pixels on a side that become one vision token after merging,
+# fixed_tokens is for encoders that always produce the same count.
+#   aspect: stretch - round both sides up to the tile size, distorting slightly
+#           pad     - keep the aspect ratio and pad out to the tile size
+#           crop    - keep the aspect ratio and crop in to the tile size
+IMAGE_PROFILES = {
+    "default": {
+        "max_dimension": 560, "patch_sizes": None, "aspect": "stretch",
+        "image_format": "JPEG", "quality": 95, "max_bytes": None,
+        "token_patch": 28, "fixed_tokens": None,
+    },
+    "qwen2-vl": {
+        "max_dimension": 560, "patch_sizes": [28], "aspect": "pad",
+        "image_format": "JPEG", "quality": 90, "max_bytes": None,
+        "token_patch": 28, "fixed_tokens": None,
+    },
+    "qwen2-vl-fast": {
+        "max_dimension": 336, "patch_sizes": [28], "aspect": "crop",
+        "image_format": "JPEG", "quality": 85, "max_bytes": 64 * 1024,
+        "token_patch": 28, "fixed_tokens": None,
+    },
+    "qwen2-vl-detail": {
+        "max_dimension": 784, "patch_sizes": [28], "aspect": "pad",
+        "image_format": "JPEG", "quality": 95, "max_bytes": None,
+        "token_patch": 28, "fixed_tokens": None,
+    },
+    "llava": {
+        "max_dimension": 336, "patch_sizes": [14], "aspect": "pad",
+        "image_format": "JPEG", "quality": 90, "max_bytes": None,
+        "token_patch": 14, "fixed_tokens": 576,
+    },
+    "gemma3": {
+        "max_dimension": 896, "patch_sizes": [14], "aspect": "pad",
+        "image_format": "JPEG", "quality": 90, "max_bytes": None,
+        "token_patch": 14, "fixed_tokens": 256,
+    },
+}
@@ -0,0 +1,193 @@
+import os
+import socket
+import time
+
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS items_state ON items(state, directory);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+class WorkQueue:
+    """ A work queue kept in a SQLite file on shared storage so that
+        several llmii processes, on one or more machines, can tag the
+        same tree without processing a file twice.
+
+        A coordinator publishes files as they are found. Workers lease
+        a batch of files from one directory at a time. A lease that is
+        not renewed before it expires goes back to pending so a crashed
+        worker doesn't strand its files. Paths are stored relative to
+        the tree root so every node can mount the share where it likes.
+    """
+    def __init__(self, path, root_dir, lease_seconds=600, max_attempts=3, worker_id=None):
+        self.path = path
+        self.root_dir = os.path.abspath(root_dir)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+
+        # sqlite3 is only loaded by runs that share a queue
+        import sqlite3
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        """ Open a connection and take the write lock right away so that
+            two workers can never lease the same rows.
+        """
+        import sqlite3
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def _relative(self, file_path):
+        return os.path.relpath(os.path.abspath(file_path), self.root_dir).replace(os.sep, "/")
+
+    def _absolute(self, rel_path):
+        return os.path.join(self.root_dir, *rel_path.split("/"))
+
+    def _set_meta(self, key, value):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def start_scan(self):
+        self._set_meta("scan_complete", "0")
+
+    def finish_scan(self):
+        self._set_meta("scan_complete", "1")
+
+    def publish(self, directory, files):
+        """ Add files to the queue. Files that are already known keep
+            their current state. Returns the number of new items.
+        """
+        now = time.time()
+        rel_dir = self._relative(directory)
+        rows = [(self._relative(f), rel_dir, now) for f in files]
+        with self._transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO items (path, directory, updated) VALUES (?, ?, ?)", rows
+            )
+            return conn.total_changes - before
+
+    def lease(self, limit=50):
+        """ Lease up to limit pending files from a single directory.
+            Returns (directory, files) with absolute paths, or
+            (None, []) if nothing is available right now.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+
+            # Hand back work from workers that died or hung
+            conn.execute(
+                "UPDATE items SET state = 'pending', worker = NULL, lease_expires = NULL "
+                "WHERE state = 'leased' AND lease_expires < ?", (now,)
+            )
+
+            # Files that keep coming back are probably killing workers
+            conn.execute(
+                "UPDATE items SET state = 'failed', result = 'too many attempts', updated = ? "
+                "WHERE state = 'pending' AND attempts >= ?", (now, self.max_attempts)
+            )
+            row = conn.execute(
+                "SELECT directory FROM items WHERE state = 'pending' ORDER BY rowid LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None, []
+
+            rel_dir = row[0]
+            paths = [r[0] for r in conn.execute(
+                "SELECT path FROM items WHERE state = 'pending' AND directory = ? ORDER BY rowid LIMIT ?",
+                (rel_dir, limit)
+            )]
+            conn.executemany(
+                "UPDATE items SET state = 'leased', worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated = ? WHERE path = ?",
+                [(self.worker_id, now + self.lease_seconds, now, p) for p in paths]
+            )
+        return self._absolute(rel_dir), [self._absolute(p) for p in paths]
+
+    def renew(self):
+        """ Extend every lease held by this worker.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE items SET lease_expires = ? WHERE state = 'leased' AND worker = ?",
+                (now + self.lease_seconds, self.worker_id)
+            )
+
+    def complete(self, file_path, result):
+        """ Record the result for a leased file. Ignored if the lease
+            was lost to another worker in the meantime.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE items SET state = 'done', result = ?, lease_expires = NULL, updated = ? "
+                "WHERE path = ? AND state = 'leased' AND worker = ?",
+                (result, time.time(), self._relative(file_path), self.worker_id)
+            )
+
+    def release(self, files=None, refund=True):
+        """ Give leased files back to the queue without a result. With
+            no files given, every lease held by this worker is released.
+            With refund the lease doesn't count as an attempt, which is
+            only right for files that were never tried.
+        """
+        refunded = 1 if refund else 0
+        with self._transaction() as conn:
+            if files is None:
+                conn.execute(
+                    "UPDATE items SET state = 'pending', worker = NULL, lease_expires = NULL, "
+                    "attempts = MAX(attempts - ?, 0) WHERE state = 'leased' AND worker = ?",
+                    (refunded, self.worker_id)
+                )
+            else:
+                conn.executemany(
+                    "UPDATE items SET state = 'pending', worker = NULL, lease_expires = NULL, "
+                    "attempts = MAX(attempts - ?, 0) WHERE path = ? AND state = 'leased' AND worker = ?",
+                    [(refunded, self._relative(f), self.worker_id) for f in files]
+                )
+
+    def counts(self):
+        with self._transaction() as conn:
+            return dict(conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+
+    def is_finished(self):
+        """ True once the scan has completed and no file is pending or
+            leased by any worker.
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'scan_complete'").fetchone()
+            if not row or row[0] != "1":
+                return False
+            open_items = conn.execute(
+                "SELECT COUNT(*) FROM items WHERE state IN ('pending', 'leased')"
+            ).fetchone()[0]
+            return open_items == 0
@@ -0,0 +1,78 @@
+class FileRecord:
+    """ One file on its way through the pipeline.
+
+        Built once from the ExifTool read and passed through checking,
+        generation and writing instead of a fresh metadata dict at each
+        step. Generation only replaces the caption and keywords when it
+        succeeds, so a retry still sees what was read from the file.
+    """
+    __slots__ = (
+        "path", "identifier", "status", "keywords", "caption", "started", "elapsed", "responses", "batch", "original"
+    )
+
+    def __init__(self, path, identifier=None, status=None, keywords=(), caption=None):
+        self.path = path
+        self.identifier = identifier
+        self.status = status
+        self.keywords = tuple(keywords or ())
+        self.caption = caption
+        self.started = None
+        self.elapsed = None
+
+        # Raw model output from the last generation
+        self.responses = None
+
+        # (archived batch id, position) when generated in a batch, whose
+        # raw answer is archived once for all of its files
+        self.batch = None
+
+        # What the file had before generation, which stays put when the
+        # keywords and caption are replaced
+        self.original = (self.keywords, caption)
+
+    @classmethod
+    def from_exiftool(cls, metadata, field_lookup):
+        """ Collapse whatever fields ExifTool returned into a record.
+            field_lookup maps each tag we read to the field it fills.
+        """
+        keywords = []
+        found = {}
+        for key, value in metadata.items():
+            target = field_lookup.get(key)
+            if target is None:
+                continue
+
+            # Collect all keywords, for the rest the last one found wins.
+            # ExifTool gives numbers back as numbers, and the same keyword
+            # is often in more than one field.
+            if target == "MWG:Keywords":
+                for keyword in value if isinstance(value, list) else [value]:
+                    keyword = str(keyword)
+                    if keyword not in keywords:
+                        keywords.append(keyword)
+            else:
+                found[target] = value
+        return cls(
+            metadata.get("SourceFile"),
+            identifier=found.get("XMP:Identifier") or None,
+            status=found.get("XMP:Status") or None,
+            keywords=keywords,
+            caption=found.get("MWG:Description") or None,
+        )
+
+    def to_tags(self):
+        """ The tags to write back. Fields with no value are left alone.
+        """
+        tags = {}
+        if self.keywords:
+            tags["MWG:Keywords"] = list(self.keywords)
+        if self.caption:
+            tags["MWG:Description"] = self.caption
+        if self.status:
+            tags["XMP:Status"] = self.status
+        if self.identifier:
+            tags["XMP:Identifier"] = self.identifier
+        return tags
+
+    def __repr__(self):
+        return f"FileRecord({self.path!r}, status={self.status!r})"
@@ -0,0 +1,217 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from llmii import Config, normalize_keyword, BANNED_WORDS, KEYWORD_FIELDS, IDENTIFIER_FIELDS, FIELD_LOOKUP
+from llmii_record import FileRecord
+from llmii_search import SearchIndex
+from llmii_exiftool import ExifToolSupervisor
+
+def _normalize_chunk(keywords):
+    return [normalize_keyword(keyword, BANNED_WORDS) for keyword in keywords]
+
+class Renormalizer:
+    """ Runs the keywords already written to files through the current
+        normalize_keyword and writes back only the files whose keyword
+        set changes. The model is never involved. Only files llmii
+        tagged, the ones with an identifier, are touched, so keywords
+        someone entered by hand elsewhere are left alone.
+
+        Every distinct keyword is normalized once, and new ones are
+        spread over worker processes a batch at a time. The changed
+        files of a batch are written by one ExifTool call, each file as
+        its own command chained with -execute.
+    """
+    def __init__(self, workers=None, dry_run=False, no_backup=False, index=None, callback=print):
+        self.workers = workers or os.cpu_count() or 1
+        self.dry_run = dry_run
+        self.no_backup = no_backup
+        self.index = index
+        self.callback = callback
+        self.normalized = {}
+        self.pool = ProcessPoolExecutor(self.workers) if self.workers > 1 else None
+        self.et = ExifToolSupervisor(callback=callback, check_execute=False)
+        self.counts = {"read": 0, "untagged": 0, "changed": 0, "written": 0}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.et.terminate()
+        if self.index is not None:
+            self.index.close()
+
+    def _normalize_new(self, keywords):
+        """ Normalize the keywords not seen yet
+        """
+        new = list({k for k in keywords if k not in self.normalized})
+        if not new:
+            return
+        if self.pool is None or len(new) < 100:
+            results = _normalize_chunk(new)
+        else:
+            size = -(-len(new) // self.workers)
+            chunks = [new[i:i + size] for i in range(0, len(new), size)]
+            results = [r for chunk in self.pool.map(_normalize_chunk, chunks) for r in chunk]
+        self.normalized.update(zip(new, results))
+
+    def renormalized(self, keywords):
+        """ The normalized keyword list, in order and without duplicates
+        """
+        result = {}
+        for keyword in keywords:
+            normalized = self.normalized[keyword]
+            if normalized:
+                result[normalized] = None
+        return list(result)
+
+    def read_files(self, files):
+        """ Read the keywords of files llmii tagged with ExifTool as
+            (path, keywords)
+        """
+        try:
+            results = self.et.get_tags(files, tags=KEYWORD_FIELDS + IDENTIFIER_FIELDS)
+        except Exception as e:
+            self.callback(f"ExifTool error: {str(e)}")
+            return []
+        records = [FileRecord.from_exiftool(metadata, FIELD_LOOKUP) for metadata in results]
+        tagged = [record for record in records if record.identifier]
+        self.counts["untagged"] += len(records) - len(tagged)
+        return [(record.path, list(record.keywords)) for record in tagged]
+
+    def process_batch(self, batch):
+        """ Take a batch of (path, keywords) and write the files whose
+            keywords change
+        """
+        self.counts["read"] += len(batch)
+        self._normalize_new(k for _, keywords in batch for k in keywords)
+        changes = []
+        for path, keywords in batch:
+            if not keywords:
+                continue
+            new = self.renormalized(keywords)
+            if set(new) != set(keywords):
+                changes.append((path, keywords, new))
+        self.counts["changed"] += len(changes)
+        if not changes:
+            return
+        if self.dry_run:
+            for path, old, new in changes:
+                removed = sorted(set(old) - set(new))
+                added = sorted(set(new) - set(old))
+                self.callback(f"{path}\n    - {', '.join(removed)}\n    + {', '.join(added)}")
+            return
+        self.write_batch(changes)
+
+    def write_batch(self, changes):
+        args = []
+        for path, _, new in changes:
+            if args:
+                args.append("-execute")
+            args.append("-P")
+            if self.no_backup:
+                args.append("-overwrite_original")
+
+            # An empty value clears keywords that were all normalized away
+            args.extend([f"-MWG:Keywords={keyword}" for keyword in new] or ["-MWG:Keywords="])
+            args.append(path)
+        try:
+            self.et.execute(*args)
+        except Exception as e:
+            self.callback(f"ExifTool error writing {len(changes)} files: {str(e)}")
+            return
+        self.counts["written"] += len(changes)
+        if self.index is not None:
+            for path, _, new in changes:
+                self.index.set_keywords(path, new)
+            self.index.commit()
+
+    def from_directory(self, directory, extensions, no_crawl=False, batch_size=500):
+        """ Batches of (path, keywords) read from the files in a tree
+        """
+        batch = []
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.lower().endswith(extensions):
+                    batch.append(os.path.join(root, filename))
+                    if len(batch) >= batch_size:
+                        yield self.read_files(batch)
+                        batch = []
+            if no_crawl:
+                break
+        if batch:
+            yield self.read_files(batch)
+
+    def from_index(self, directory, no_crawl=False, batch_size=500):
+        """ Batches of (path, keywords) taken from the search index.
+            Files modified since they were indexed are read again, so
+            keywords added by hand since aren't lost.
+        """
+        batch = []
+        stale = []
+        directory = os.path.abspath(directory)
+        for path, identifier, keywords, updated in self.index.files(directory):
+            if no_crawl and os.path.dirname(path) != directory:
+                continue
+            if not identifier:
+                self.counts["untagged"] += 1
+                continue
+            try:
+                modified = os.path.getmtime(path)
+            except OSError:
+                continue
+            if updated is None or modified > updated:
+                stale.append(path)
+            else:
+                batch.append((path, keywords))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+            if len(stale) >= batch_size:
+                yield self.read_files(stale)
+                stale = []
+        if batch:
+            yield batch
+        if stale:
+            yield self.read_files(stale)
+
+def main():
+    parser = argparse.ArgumentParser(description="Normalize the keywords already in tagged images again with the current rules")
+    parser.add_argument("directory", help="Directory containing the images")
+    parser.add_argument("--no-crawl", action="store_true", help="Disable crawling subdirectories")
+    parser.add_argument("--index", default=None, help="Take keywords from this search index instead of reading every file")
+    parser.add_argument("--workers", type=int, default=None, help="Processes normalizing keywords (default: one per CPU)")
+    parser.add_argument("--batch-size", type=int, default=500, help="Files read and written per ExifTool call")
+    parser.add_argument("--dry-run", action="store_true", help="Show what would change without writing")
+    parser.add_argument("--no-backup", action="store_true", help="Don't make backups of files")
+    args = parser.parse_args()
+
+    index = None
+    if args.index:
+        if not os.path.exists(args.index):
+            print(f"No index at {args.index}")
+            return
+        index = SearchIndex(args.index)
+    extensions = tuple(ext for exts in Config().image_extensions.values() for ext in exts)
+    renormalizer = Renormalizer(args.workers, args.dry_run, args.no_backup, index)
+    start = time.perf_counter()
+    try:
+        if index is not None:
+            batches = renormalizer.from_index(args.directory, args.no_crawl, args.batch_size)
+        else:
+            batches = renormalizer.from_directory(args.directory, extensions, args.no_crawl, args.batch_size)
+        for batch in batches:
+            renormalizer.process_batch(batch)
+    except KeyboardInterrupt:
+        print("Stopped.")
+    finally:
+        renormalizer.close()
+    counts = renormalizer.counts
+    if any(renormalizer.et.stats.values()):
+        print(renormalizer.et.report())
+    print(f"{counts['read']} files checked, {counts['changed']} with changed keywords, "
+          f"{counts['written']} written in {time.perf_counter() - start:.1f}s. "
+          f"{counts['untagged']} files not tagged by llmii were left alone")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import itertools
+import os
+import queue
+import threading
+
+def _stat(file_path):
+    try:
+        return os.stat(file_path)
+    except OSError:
+        return None
+
+# Each policy sorts a batch in place and returns the key the batch is
+# ranked by, lowest first. Sorting in place keeps the list the memory
+# budget accounted for.
+
+def fifo_order(files):
+    """ Leave the batch as found
+    """
+    return 0
+
+def newest_order(files):
+    """ Most recently modified files first, and the batch holding the
+        newest file ahead of older batches.
+    """
+    mtimes = {}
+    for file_path in files:
+        stat = _stat(file_path)
+        mtimes[file_path] = stat.st_mtime if stat else 0
+    files.sort(key=lambda f: -mtimes[f])
+    return -mtimes[files[0]] if files else 0
+
+def smallest_order(files):
+    """ Smallest files first, since they are the quickest to finish
+    """
+    sizes = {}
+    for file_path in files:
+        stat = _stat(file_path)
+        sizes[file_path] = stat.st_size if stat else 0
+    files.sort(key=lambda f: sizes[f])
+    return sizes[files[0]] if files else 0
+
+SCHEDULE_POLICIES = {
+    "fifo": fifo_order,
+    "newest": newest_order,
+    "smallest": smallest_order,
+}
+
+class ScheduledQueue(queue.PriorityQueue):
+    """ Drop in for the metadata queue that hands out directory batches
+        by a scheduling policy instead of in the order they were found.
+
+        Batches under one of the priority directories always go first.
+        Within that the policy decides, and batches it ranks the same
+        keep their scan order. Only what the scanner has found so far
+        can be reordered, so with a tight --max-buffer-mb the order is
+        best effort.
+        
+        A big directory is queued in several batches which may now come
+        out in any order, so a batch is only handed out as completing
+        its directory once it is the last one of that directory left.
+    """
+    def __init__(self, policy="fifo", priority_dirs=None):
+        queue.PriorityQueue.__init__(self)
+        self.order = SCHEDULE_POLICIES[policy]
+        self.priority_dirs = [os.path.join(os.path.abspath(d), "") for d in priority_dirs or []]
+        self.counter = itertools.count()
+        self.outstanding = {}
+        self.closed = set()
+        self.lock = threading.Lock()
+
+    def is_priority(self, directory):
+        directory = os.path.join(os.path.abspath(directory), "")
+        return any(directory.startswith(d) for d in self.priority_dirs)
+
+    def put(self, item, block=True, timeout=None):
+        directory, files, complete = item
+        key = self.order(files)
+        rank = 0 if self.is_priority(directory) else 1
+        with self.lock:
+            self.outstanding[directory] = self.outstanding.get(directory, 0) + 1
+            if complete:
+                self.closed.add(directory)
+        queue.PriorityQueue.put(self, (rank, key, next(self.counter), (directory, files)), block, timeout)
+
+    def get(self, block=True, timeout=None):
+        directory, files = queue.PriorityQueue.get(self, block, timeout)[-1]
+        with self.lock:
+            self.outstanding[directory] -= 1
+            complete = directory in self.closed and not self.outstanding[directory]
+            if not self.outstanding[directory]:
+                del self.outstanding[directory]
+                self.closed.discard(directory)
+        return directory, files, complete
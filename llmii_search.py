@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    identifier TEXT,
+    caption TEXT,
+    keywords TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS file_keywords (
+    keyword TEXT NOT NULL,
+    file_id INTEGER NOT NULL,
+    PRIMARY KEY (keyword, file_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS file_keywords_file ON file_keywords(file_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS file_text USING fts5(caption, keywords);
+"""
+
+def keyword_list(stored):
+    """ The keywords of a files row. They are kept as a JSON list, but
+        older indexes joined them with ", ".
+    """
+    if not stored:
+        return []
+    if stored.startswith("["):
+        try:
+            return json.loads(stored)
+        except ValueError:
+            pass
+    return [k for k in stored.split(", ") if k]
+
+class SearchIndex:
+    """ Keywords and captions of tagged files in a SQLite file, so they
+        can be searched without ExifTool reading every file again.
+
+        Exact keywords are looked up, ignoring case, in their own table
+        with the original list kept on the file, and captions go
+        into an FTS5 table for full text queries. A file is replaced
+        whenever it is written again. Updates are committed in batches
+        by calling commit.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        
+        # sqlite3 is only loaded by runs that keep an index
+        import sqlite3
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def update(self, record):
+        """ Add or replace the entry for a FileRecord
+        """
+        path = os.path.abspath(record.path)
+        keywords = list(dict.fromkeys(str(keyword) for keyword in record.keywords))
+        stored = json.dumps(keywords)
+        joined = ", ".join(keywords)
+        with self.lock:
+            row = self.conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+            if row:
+                file_id = row[0]
+                self.conn.execute(
+                    "UPDATE files SET identifier = ?, caption = ?, keywords = ?, updated = ? WHERE id = ?",
+                    (record.identifier, record.caption, stored, time.time(), file_id)
+                )
+                self.conn.execute("DELETE FROM file_keywords WHERE file_id = ?", (file_id,))
+                self.conn.execute("DELETE FROM file_text WHERE rowid = ?", (file_id,))
+            else:
+                file_id = self.conn.execute(
+                    "INSERT INTO files (path, identifier, caption, keywords, updated) VALUES (?, ?, ?, ?, ?)",
+                    (path, record.identifier, record.caption, stored, time.time())
+                ).lastrowid
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO file_keywords (keyword, file_id) VALUES (?, ?)",
+                [(keyword.lower(), file_id) for keyword in keywords]
+            )
+            self.conn.execute(
+                "INSERT INTO file_text (rowid, caption, keywords) VALUES (?, ?, ?)",
+                (file_id, record.caption or "", joined)
+            )
+
+    def set_keywords(self, path, keywords):
+        """ Replace the keywords of an indexed file, keeping the rest
+        """
+        path = os.path.abspath(path)
+        keywords = list(dict.fromkeys(str(keyword) for keyword in keywords))
+        stored = json.dumps(keywords)
+        joined = ", ".join(keywords)
+        with self.lock:
+            row = self.conn.execute("SELECT id, caption FROM files WHERE path = ?", (path,)).fetchone()
+            if not row:
+                return
+            file_id, caption = row
+            self.conn.execute(
+                "UPDATE files SET keywords = ?, updated = ? WHERE id = ?", (stored, time.time(), file_id)
+            )
+            self.conn.execute("DELETE FROM file_keywords WHERE file_id = ?", (file_id,))
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO file_keywords (keyword, file_id) VALUES (?, ?)",
+                [(keyword.lower(), file_id) for keyword in keywords]
+            )
+            self.conn.execute("DELETE FROM file_text WHERE rowid = ?", (file_id,))
+            self.conn.execute(
+                "INSERT INTO file_text (rowid, caption, keywords) VALUES (?, ?, ?)",
+                (file_id, caption or "", joined)
+            )
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def search(self, keywords=(), text=None, prefix=None, limit=100):
+        """ Return (path, caption, keywords) for files that have all of
+            the keywords, in any case, and match the FTS5 text query. A text query on
+            its own returns the best matches first. prefix limits
+            results to a directory.
+        """
+        sql = "SELECT f.path, f.caption, f.keywords FROM files f"
+        where = []
+        params = []
+        if text:
+            sql += " JOIN file_text ON file_text.rowid = f.id"
+            where.append("file_text MATCH ?")
+            params.append(text)
+        for keyword in keywords:
+            where.append("f.id IN (SELECT file_id FROM file_keywords WHERE keyword = ?)")
+            params.append(str(keyword).lower())
+        if prefix:
+            where.append("f.path >= ? AND f.path < ?")
+            prefix = os.path.join(os.path.abspath(prefix), "")
+            params.extend([prefix, prefix + "\uffff"])
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+
+        # Ranking every text match is slow for common words, so results
+        # narrowed down by keyword come back in path order instead
+        sql += " ORDER BY rank" if text and not keywords else " ORDER BY f.path"
+        sql += " LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [(path, caption, ", ".join(keyword_list(keywords))) for path, caption, keywords in rows]
+
+    def files(self, prefix=None, batch_size=1000):
+        """ Yield (path, identifier, keywords, updated) for every indexed
+            file, optionally only those under a directory
+        """
+        sql = "SELECT id, path, identifier, keywords, updated FROM files WHERE id > ?"
+        params = []
+        if prefix:
+            sql += " AND path >= ? AND path < ?"
+            prefix = os.path.join(os.path.abspath(prefix), "")
+            params = [prefix, prefix + "\uffff"]
+        sql += " ORDER BY id LIMIT ?"
+        
+        # Read in pages so the connection isn't held for the whole walk
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(sql, [last] + params + [batch_size]).fetchall()
+            if not rows:
+                return
+            for file_id, path, identifier, keywords, updated in rows:
+                yield path, identifier, keyword_list(keywords), updated
+            last = rows[-1][0]
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the keywords and captions of tagged images")
+    parser.add_argument("index", help="Index file given to --index")
+    parser.add_argument("keywords", nargs="*", help="Keywords the image must have, all of them")
+    parser.add_argument("--text", default=None, help="Full text query over captions and keywords")
+    parser.add_argument("--under", default=None, help="Only images in this directory")
+    parser.add_argument("--limit", type=int, default=100, help="Maximum number of results")
+    parser.add_argument("--captions", action="store_true", help="Show the caption of each result")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.index):
+        print(f"No index at {args.index}")
+        return
+    import sqlite3
+    index = SearchIndex(args.index)
+    try:
+        start = time.perf_counter()
+        try:
+            results = index.search(args.keywords, args.text, args.under, args.limit)
+        except sqlite3.OperationalError as e:
+            print(f"Bad text query: {str(e)}")
+            return
+        elapsed = time.perf_counter() - start
+        for path, caption, keywords in results:
+            print(path)
+            if args.captions:
+                print(f"    {caption}")
+                print(f"    {keywords}")
+        print(f"{len(results)} results of {index.count()} images in {elapsed * 1000:.1f} ms")
+    finally:
+        index.close()
+
+if __name__ == "__main__":
+    main()
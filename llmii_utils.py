@@ -1109,3 +1109,51 @@ def de_pluralize(word, custom={}):
 
     # If no rules apply, return the original word
     return word
+
+class JsonStreamScanner:
+    """ Finds complete top level JSON objects in text that arrives a
+        piece at a time, such as tokens streamed from a model. Text
+        outside of braces is ignored and braces inside strings are
+        not counted.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.current = []
+
+    def feed(self, text):
+        """ Add more text. Returns a list of any dicts completed by it.
+        """
+        found = []
+        for char in text:
+            if self.depth == 0:
+                if char == "{":
+                    self.depth = 1
+                    self.current = [char]
+                continue
+                
+            self.current.append(char)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+                
+            if char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        obj = json.loads("".join(self.current))
+                    except ValueError:
+                        continue
+                    if isinstance(obj, dict):
+                        found.append(obj)
+        return found
@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import threading
+
+class KeywordVocabulary:
+    """ Every normalized keyword seen, with how many files it was
+        written to.
+
+        The same few thousand keywords come back from the model over and
+        over, so each one is kept as a single shared string and the
+        records point at that instead of a fresh copy per file. With a
+        path the counts are loaded at start and saved as the run goes,
+        so they add up across runs.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.counts = {}
+        self.strings = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        if path and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for keyword, count in data.get("keywords", {}).items():
+            keyword = self.intern(keyword)
+            self.counts[keyword] = count
+
+    def save(self):
+        """ Write the counts out if anything changed. The file is
+            replaced in one step so a crash can't leave half of it.
+        """
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            data = {"keywords": dict(sorted(self.counts.items(), key=lambda item: -item[1]))}
+            self.dirty = False
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+        os.replace(temp_path, self.path)
+
+    def intern(self, keyword):
+        """ Return the shared copy of a keyword
+        """
+        return self.strings.setdefault(keyword, keyword)
+
+    def add(self, keywords):
+        """ Count the keywords written to one file
+        """
+        with self.lock:
+            for keyword in keywords:
+                keyword = self.intern(keyword)
+                self.counts[keyword] = self.counts.get(keyword, 0) + 1
+            self.dirty = True
+
+    def top(self, n=20):
+        """ The n most used keywords as (keyword, count)
+        """
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))[:n]
+
+    def rare(self, max_count=1, limit=None):
+        """ Keywords used on at most max_count files, rarest first
+        """
+        rare = sorted(
+            ((k, c) for k, c in self.counts.items() if c <= max_count),
+            key=lambda item: (item[1], item[0])
+        )
+        return rare[:limit] if limit else rare
+
+    def __len__(self):
+        return len(self.counts)
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the keyword vocabulary saved by a run")
+    parser.add_argument("path", help="Vocabulary file given to --vocabulary")
+    parser.add_argument("--top", type=int, default=20, help="Show the N most used keywords")
+    parser.add_argument("--rare", type=int, default=None, help="Show keywords used on at most this many files")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of rare keywords to show")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        print(f"No vocabulary file at {args.path}")
+        return
+    vocabulary = KeywordVocabulary(args.path)
+    total = sum(vocabulary.counts.values())
+    print(f"{len(vocabulary)} keywords, {total} uses")
+    if args.rare is not None:
+        results = vocabulary.rare(args.rare, args.limit)
+    else:
+        results = vocabulary.top(args.top)
+    for keyword, count in results:
+        print(f"{count:>8}  {keyword}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+""" Stands in for exiftool -stay_open. Every file is answered with a
+    made up tag, except that a file with "hang" in its name never gets
+    an answer and one with "crash" in its name kills the process.
+"""
+import json
+import os
+import sys
+import time
+
+args = []
+for line in sys.stdin:
+    line = line.rstrip("\n")
+    if not line.startswith("-execute"):
+        args.append(line)
+        continue
+    number = line[len("-execute"):]
+    if "-ver" in args:
+        out = "12.40"
+    else:
+        files = [arg for i, arg in enumerate(args) if not arg.startswith(("-", "=")) and args[i - 1] != "-echo4"]
+        results = []
+        for name in files:
+            if "hang" in name:
+                time.sleep(3600)
+            if "crash" in name:
+                os._exit(1)
+            results.append({"SourceFile": name, "XMP:Subject": "x"})
+        out = json.dumps(results) if "-j" in args else "1 image files updated"
+    sys.stdout.write(f"{out}\n{{ready{number}}}\n")
+    sys.stdout.flush()
+    sys.stderr.write(f"=0=post{number}\n")
+    sys.stderr.flush()
+    args = []
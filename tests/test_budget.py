@@ -0,0 +1,44 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from llmii_budget import MemoryBudget
+
+
+def test_try_acquire_respects_share():
+    budget = MemoryBudget(100)
+    assert budget.try_acquire("images", 50)
+    assert not budget.try_acquire("images", 20)
+    budget.release("images", 50)
+    assert budget.try_acquire("images", 20)
+
+
+def test_waiting_coroutines_leave_threads_free():
+    """ More coroutines waiting for room than there are executor threads,
+        each needing a thread to finish its work and release
+    """
+    budget = MemoryBudget(100)
+    finished = []
+
+    async def work(number):
+        assert await budget.acquire_async("images", 20)
+        try:
+            await asyncio.to_thread(time.sleep, 0.01)
+            finished.append(number)
+        finally:
+            budget.release("images", 20)
+
+    async def run():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(2))
+        await asyncio.wait_for(asyncio.gather(*(work(i) for i in range(16))), 10)
+
+    asyncio.run(run())
+    assert len(finished) == 16
+    assert budget.used["images"] == 0
+
+
+def test_acquire_async_stops():
+    budget = MemoryBudget(100)
+    budget.try_acquire("images", 60)
+    assert not asyncio.run(budget.acquire_async("images", 60, lambda: True))
+    assert budget.used["images"] == 60
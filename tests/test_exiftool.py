@@ -0,0 +1,121 @@
+import os
+import sys
+
+import exiftool
+import pytest
+
+from llmii_exiftool import ExifToolFailure, ExifToolGaveUp, ExifToolSupervisor
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="the fake ExifTool is a script run through its shebang")
+
+
+@pytest.fixture
+def fake_exiftool(tmp_path):
+    with open(os.path.join(os.path.dirname(__file__), "fake_exiftool.py")) as f:
+        source = f.read()
+    path = tmp_path / "exiftool"
+    path.write_text(f"#!{sys.executable}\n{source}")
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def supervisor(fake_exiftool):
+    supervisors = []
+
+    def make(**kwargs):
+        kwargs.setdefault("timeout", 1)
+        kwargs.setdefault("per_file", 0.1)
+        supervisor = ExifToolSupervisor(callback=lambda message: None, executable=fake_exiftool, **kwargs)
+        supervisors.append(supervisor)
+        return supervisor
+
+    yield make
+    for supervisor in supervisors:
+        supervisor.terminate()
+        for left in supervisor._abandoned:
+
+            # Helpers left behind without the internals still hang
+            process = getattr(getattr(left, "inner", None), "_process", None)
+            if process is not None:
+                process.kill()
+                process.wait()
+
+
+class HiddenInternals:
+    """ An ExifToolHelper without the private parts the supervisor uses,
+        like a pyexiftool version that doesn't have them
+    """
+    helper_class = exiftool.ExifToolHelper
+
+    def __init__(self, **kwargs):
+        self.inner = self.helper_class(**kwargs)
+
+    def __getattr__(self, name):
+        if name in ("_process", "_flag_running_false"):
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+
+def sources(results):
+    return [result["SourceFile"] for result in results]
+
+
+def test_reads_batch(supervisor):
+    et = supervisor()
+    assert sources(et.get_tags(["a.jpg", "b.jpg"])) == ["a.jpg", "b.jpg"]
+    assert et.stats == {"restarts": 0, "timeouts": 0, "skipped": 0}
+
+
+def test_hang_isolated_in_batch(supervisor):
+    et = supervisor()
+    assert sources(et.get_tags(["a.jpg", "hang.jpg", "c.jpg"])) == ["a.jpg", "c.jpg"]
+
+    # Once for the batch and once for the file on its own
+    assert et.stats == {"restarts": 2, "timeouts": 2, "skipped": 1}
+    assert et.skipped == ["hang.jpg"]
+    assert sources(et.get_tags(["d.jpg"])) == ["d.jpg"]
+
+
+def test_crash_isolated_in_batch(supervisor):
+    et = supervisor()
+    assert sources(et.get_tags(["a.jpg", "crash.jpg", "c.jpg"])) == ["a.jpg", "c.jpg"]
+    assert et.stats == {"restarts": 2, "timeouts": 0, "skipped": 1}
+    assert et.skipped == ["crash.jpg"]
+
+
+def test_single_file_write_not_retried(supervisor):
+    et = supervisor()
+    with pytest.raises(ExifToolFailure):
+        et.set_tags("hang.jpg", {"XMP:Subject": "y"})
+    assert et.stats["restarts"] == 1
+    assert "updated" in et.set_tags("ok.jpg", {"XMP:Subject": "y"})
+
+
+def test_dead_process_restarted_before_call(supervisor):
+    et = supervisor()
+    et.helper._process.kill()
+    et.helper._process.wait()
+    assert sources(et.get_tags(["a.jpg"])) == ["a.jpg"]
+    assert et.stats["restarts"] == 1
+    assert et.stats["timeouts"] == 0
+
+
+def test_gives_up_after_max_hangs(supervisor):
+    et = supervisor(max_hangs=2)
+    for name in ("hang1.jpg", "crash.jpg"):
+        with pytest.raises(ExifToolFailure):
+            et.set_tags(name, {"XMP:Subject": "y"})
+    with pytest.raises(ExifToolGaveUp):
+        et.get_tags(["a.jpg"])
+    assert et.stats["restarts"] == 2
+
+
+def test_without_pyexiftool_internals(supervisor, monkeypatch):
+    monkeypatch.setattr(exiftool, "ExifToolHelper", HiddenInternals)
+    et = supervisor()
+    assert not et.managed
+    assert sources(et.get_tags(["a.jpg", "hang.jpg", "c.jpg"])) == ["a.jpg", "c.jpg"]
+    assert et.stats == {"restarts": 2, "timeouts": 2, "skipped": 1}
+    assert len(et._abandoned) == 2
+    assert sources(et.get_tags(["d.jpg"])) == ["d.jpg"]
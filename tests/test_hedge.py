@@ -0,0 +1,97 @@
+import asyncio
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from llmii import AsyncLLMProcessor, Config
+from llmii_async import ImagePayload
+
+
+class FakeWrapper:
+    def wrap_prompt(self, instruction, system_instruction, content):
+        return instruction
+
+
+class FakeCore:
+    template_wrapper = FakeWrapper()
+
+    def get_generation_params(self):
+        return {}
+
+
+def fake_server(delays):
+    """ A KoboldCpp stand-in that holds each generation for the next
+        delay in delays, answering with the request's number
+    """
+    calls = {"generate": 0, "aborted": []}
+
+    async def generate(request):
+        await request.read()
+        calls["generate"] += 1
+        number = calls["generate"]
+        await asyncio.sleep(delays[min(number, len(delays)) - 1])
+        return web.json_response({"results": [{"text": f"answer {number}"}]})
+
+    async def abort(request):
+        body = await request.json()
+        calls["aborted"].append(body["genkey"])
+        return web.json_response({"success": True})
+
+    app = web.Application()
+    app.add_routes([web.post("/api/v1/generate", generate), web.post("/api/extra/abort", abort)])
+    return app, calls
+
+
+def make_processor(url, concurrency=1):
+    config = Config()
+    config.api_url = url
+    config.concurrency = concurrency
+    config.hedge = True
+    config.request_timeout = 30
+    return AsyncLLMProcessor(config, FakeCore())
+
+
+def test_hedge_wins_against_slow_request():
+    async def run():
+        app, calls = fake_server([10, 0.05])
+        async with TestServer(app) as server:
+            processor = make_processor(str(server.make_url("")))
+            for _ in range(20):
+                processor.latency.add(0.1)
+
+            # With one connection per client the hedge still gets out
+            # while the slow request holds the primary pool
+            start = time.monotonic()
+            try:
+                text = await processor._generate("prompt", None)
+            finally:
+                await processor.close()
+            return text, time.monotonic() - start, processor.stats, calls
+
+    text, elapsed, stats, calls = asyncio.run(run())
+    assert text == "answer 2"
+    assert elapsed < 5
+    assert stats["hedged"] == 1
+    assert stats["hedge_wins"] == 1
+    assert len(calls["aborted"]) == 1
+
+
+def test_batches_and_continuations_not_recorded():
+    async def run():
+        app, _ = fake_server([0.01])
+        image = ImagePayload("aW1hZ2U=")
+        async with TestServer(app) as server:
+            processor = make_processor(str(server.make_url("")))
+            try:
+                await processor.describe_batch([image, image])
+                await processor.continue_content("keywords", image, "partial ")
+                before = len(processor.latency.samples)
+                await processor.describe_content("keywords", image)
+            finally:
+                await processor.close()
+            return before, len(processor.latency.samples)
+
+    before, after = asyncio.run(run())
+    assert before == 0
+    assert after == 1